@@ -0,0 +1,18 @@
+"""Synthetic panels shared by the benchmarks."""
+import numpy as np
+import pandas as pd
+
+
+def make_panel(n_series, n_time, seasonality, seed=1, random_levels=False):
+  """Long X_df and y_df of daily seasonal series with three categories. Serie i
+  is shifted by i, or by a random level in [0, 5) with random_levels."""
+  rng = np.random.RandomState(seed)
+  t = np.arange(n_time)
+  y = 10 + np.sin(2 * np.pi * t / seasonality)[None, :] + rng.rand(n_series, n_time)
+  y = y + (rng.rand(n_series, 1) * 5 if random_levels else np.arange(n_series)[:, None])
+  ds = pd.date_range('2000-01-01', periods=n_time, freq='D')
+  df = pd.DataFrame({'unique_id': np.repeat(['id_{}'.format(i) for i in range(n_series)], n_time),
+                     'ds': np.tile(ds, n_series),
+                     'x': np.repeat(['c{}'.format(i % 3) for i in range(n_series)], n_time),
+                     'y': y.ravel()})
+  return df[['unique_id', 'ds', 'x']], df[['unique_id', 'ds', 'y']]
@@ -0,0 +1,50 @@
+"""Epoch time of data-parallel ESRNN training on one box, per number of processes.
+
+Usage: python benchmarks/distributed_training.py [max_world_size]
+"""
+import os
+import sys
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from esrnn.contrib.ESRNN import ESRNN
+from esrnn.contrib.utils import distributed
+from benchmarks.common import make_panel
+
+
+def fit(rank, world_size, n_series, n_time, max_epochs, times):
+  X_df, y_df = make_panel(n_series, n_time, seasonality=7)
+  model = ESRNN(max_epochs=max_epochs, batch_size=32, seasonality=7, input_size=7, output_size=14,
+                es_engine='fused', distributed=world_size > 1)
+  model.fit(X_df, y_df)
+  if rank == 0:
+    times[world_size] = model.train_stats['train_time'] / max_epochs
+
+
+def main(max_world_size=None, n_series=512, n_time=200, max_epochs=2):
+  max_world_size = max_world_size or os.cpu_count()
+  times = {}
+  fit(0, 1, n_series, n_time, max_epochs, times)
+  world_size = 2
+  while world_size <= max_world_size:
+    # Rank 0 reports its epoch time through a file, spawned processes do not share memory
+    path = os.path.join('/tmp', 'esrnn_distributed_{}.npy'.format(world_size))
+    distributed.spawn(_fit_to_file, world_size, args=(n_series, n_time, max_epochs, path))
+    times[world_size] = float(np.load(path))
+    world_size *= 2
+
+  print('{:>10} {:>14} {:>8}'.format('processes', 'epoch time (s)', 'speedup'))
+  for world_size, epoch_time in sorted(times.items()):
+    print('{:>10} {:>14.3f} {:>8.2f}'.format(world_size, epoch_time, times[1] / epoch_time))
+
+
+def _fit_to_file(rank, world_size, n_series, n_time, max_epochs, path):
+  times = {}
+  fit(rank, world_size, n_series, n_time, max_epochs, times)
+  if rank == 0:
+    np.save(path, times[world_size])
+
+
+if __name__ == '__main__':
+  main(int(sys.argv[1]) if len(sys.argv) > 1 else None)
@@ -0,0 +1,90 @@
+"""Compares the reshape-based dilation of DRNN with the former cat/stack one.
+
+Usage: python benchmarks/drnn_dilation.py
+"""
+import os
+import sys
+import time
+
+import torch
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from esrnn.contrib.utils.DRNN import DRNN
+
+
+class CatDRNN(DRNN):
+  """DRNN with the former dilation, one copy per slice, stack and padding."""
+  def _apply_cell(self, dilated_inputs, cell, batch_size, rate, hidden_size, hidden=None):
+    if hidden is None:
+      c, m = self.init_hidden(batch_size * rate, hidden_size)
+      hidden = (c.unsqueeze(0), m.unsqueeze(0))
+    return cell(dilated_inputs, hidden)
+
+  def _split_outputs(self, dilated_outputs, rate):
+    batchsize = dilated_outputs.size(1) // rate
+    blocks = [dilated_outputs[:, i * batchsize: (i + 1) * batchsize, :] for i in range(rate)]
+    interleaved = torch.stack((blocks)).transpose(1, 0).contiguous()
+    return interleaved.view(dilated_outputs.size(0) * rate, batchsize, dilated_outputs.size(2))
+
+  def _pad_inputs(self, inputs, n_steps, rate):
+    if (n_steps % rate) == 0:
+      return inputs, n_steps // rate
+    dilated_steps = n_steps // rate + 1
+    zeros_ = torch.zeros(dilated_steps * rate - inputs.size(0), inputs.size(1), inputs.size(2))
+    return torch.cat((inputs, zeros_)), dilated_steps
+
+  def _prepare_inputs(self, inputs, rate):
+    return torch.cat([inputs[j::rate, :, :] for j in range(rate)], 1)
+
+
+def make_stack(drnn_class, dilations, input_size, state_hsize):
+  # One single layer DRNN per group of dilations, as in _RNN
+  torch.manual_seed(1)
+  return [drnn_class(input_size if i == 0 else state_hsize, state_hsize, n_layers=1,
+                     dilations=group, cell_type='LSTM') for i, group in enumerate(dilations)]
+
+
+def run_stack(stack, inputs):
+  for i, layer in enumerate(stack):
+    output, _ = layer(inputs)
+    inputs = output + inputs if i > 0 else output
+  return inputs
+
+
+def time_step(stack, inputs, repetitions):
+  # Forward and backward pass, as in one training step
+  for r in range(repetitions+1):
+    if r == 1:
+      start = time.perf_counter()
+    run_stack(stack, inputs).sum().backward()
+  return (time.perf_counter()-start) / repetitions
+
+
+def check_same_numbers(dilations, n_steps, batch_size, input_size, state_hsize):
+  inputs = torch.randn(n_steps, batch_size, input_size)
+  outputs = []
+  for drnn_class in [CatDRNN, DRNN]:
+    stack = make_stack(drnn_class, dilations, input_size, state_hsize)
+    x = inputs.clone().requires_grad_(True)
+    output = run_stack(stack, x)
+    output.pow(2).sum().backward()
+    outputs.append([output, x.grad] + [p.grad for layer in stack for p in layer.parameters()])
+  return max([(a-b).abs().max().item() for a, b in zip(*outputs)])
+
+
+def main(repetitions=10, input_size=7, state_hsize=40):
+  configs = [[[1, 2], [4, 8]], [[1], [2], [4], [8]], [[1, 7], [14, 28]]]
+  print('{:>24} {:>8} {:>6} {:>10} {:>13} {:>8} {:>9}'.format('dilations', 'n_steps', 'batch', 'cat (ms)',
+                                                              'reshape (ms)', 'speedup', 'max diff'))
+  for dilations in configs:
+    for n_steps, batch_size in [(50, 32), (123, 256)]:
+      inputs = torch.randn(n_steps, batch_size, input_size)
+      times = [time_step(make_stack(drnn_class, dilations, input_size, state_hsize), inputs, repetitions)
+               for drnn_class in [CatDRNN, DRNN]]
+      diff = check_same_numbers(dilations, n_steps, batch_size, input_size, state_hsize)
+      print('{:>24} {:>8} {:>6} {:>10.2f} {:>13.2f} {:>8.2f} {:>9.1e}'.format(
+            str(dilations), n_steps, batch_size, 1000*times[0], 1000*times[1], times[0]/times[1], diff))
+
+
+if __name__ == '__main__':
+  main()
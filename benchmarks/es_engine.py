@@ -0,0 +1,72 @@
+"""Compares the 'python' and 'fused' exponential smoothing engines of _ES.
+
+Usage: python benchmarks/es_engine.py
+"""
+import os
+import sys
+import time
+
+import torch
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from esrnn.contrib.utils.config import ModelConfig
+from esrnn.contrib.utils.ESRNN import _ES
+
+
+class TSObject(object):
+  def __init__(self, y):
+    self.y = y
+    self.idxs = torch.arange(len(y))
+
+
+def make_es(es_engine, n_series, seasonality):
+  mc = ModelConfig(max_epochs=1, batch_size=n_series, learning_rate=1e-3, per_series_lr_multip=1,
+                   gradient_eps=1e-6, gradient_clipping_threshold=20, lr_scheduler_step_size=9,
+                   noise_std=0.001, level_variability_penalty=80, tau=0.5, c_state_penalty=0,
+                   state_hsize=40, dilations=[[1, 2], [4, 8]], add_nl_layer=False,
+                   seasonality=seasonality, input_size=seasonality, output_size=2*seasonality,
+                   frequency='D', max_periods=20, device='cpu', root_dir='./', es_engine=es_engine)
+  mc.n_series = n_series
+  return _ES(mc)
+
+
+def time_step(es, ts_object, repetitions):
+  # Forward and backward pass, as in one training step
+  for r in range(repetitions+1):
+    if r == 1:
+      start = time.perf_counter()
+    levels, seasonalities = es(ts_object)
+    (torch.log(levels).sum() + seasonalities.sum()).backward()
+  return (time.perf_counter()-start) / repetitions
+
+
+def check_same_numbers(n_series, n_time, seasonality):
+  ts_object = TSObject(torch.rand(n_series, n_time) + 1)
+  outputs = []
+  for es_engine in ['python', 'fused']:
+    es = make_es(es_engine, n_series, seasonality)
+    levels, seasonalities = es(ts_object)
+    (torch.log(levels).sum() + seasonalities.sum()).backward()
+    outputs.append([levels, seasonalities] + [p.grad for p in es.parameters()])
+  return max([(a-b).abs().max().item() for a, b in zip(*outputs)])
+
+
+def main(repetitions=10):
+  torch.manual_seed(1)
+  print('max abs difference python vs fused: {:.2e}'.format(check_same_numbers(16, 100, 7)))
+  print('{:>12} {:>8} {:>8} {:>12} {:>12} {:>8}'.format('seasonality', 'n_time', 'batch',
+                                                       'python (ms)', 'fused (ms)', 'speedup'))
+  # Series lengths max_periods * seasonality + input_size + output_size, as capped by ModelConfig
+  for seasonality in [4, 7, 12, 24]:
+    n_time = 20 * seasonality + 3 * seasonality
+    for batch_size in [8, 64]:
+      ts_object = TSObject(torch.rand(batch_size, n_time) + 1)
+      timings = [time_step(make_es(es_engine, batch_size, seasonality), ts_object, repetitions)
+                 for es_engine in ['python', 'fused']]
+      print('{:>12} {:>8} {:>8} {:>12.2f} {:>12.2f} {:>7.1f}x'.format(seasonality, n_time, batch_size,
+                                                                      1000*timings[0], 1000*timings[1],
+                                                                      timings[0]/timings[1]))
+
+
+if __name__ == '__main__':
+  main()
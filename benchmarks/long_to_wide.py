@@ -0,0 +1,86 @@
+"""Time and peak memory of ESRNN.long_to_wide against the previous pivot-based version.
+
+Usage: python benchmarks/long_to_wide.py [n_series] [n_ds]
+"""
+import os
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from esrnn.contrib.utils.data import long_to_wide
+
+
+def pivot_long_to_wide(X_df, y_df):
+  # Previous implementation, kept for reference
+  data = X_df.copy()
+  data['y'] = y_df['y'].copy()
+  sorted_ds = np.sort(data['ds'].unique())
+  ds_map = {}
+  for dmap, t in enumerate(sorted_ds):
+      ds_map[t] = dmap
+  data['ds_map'] = data['ds'].map(ds_map)
+  data = data.sort_values(by=['ds_map','unique_id'])
+  df_wide = data.pivot(index='unique_id', columns='ds_map')['y']
+
+  x_unique = data[['unique_id', 'x']].groupby('unique_id').first()
+  last_ds =  data[['unique_id', 'ds']].groupby('unique_id').last()
+  df_wide['x'] = x_unique
+  df_wide['last_ds'] = last_ds
+  df_wide = df_wide.reset_index().rename_axis(None, axis=1)
+
+  ds_cols = data.ds_map.unique().tolist()
+  X = df_wide.filter(items=['unique_id', 'x', 'last_ds']).values
+  y = df_wide.filter(items=ds_cols).values
+  return X, y
+
+
+def make_panel(n_series, n_ds, seed=1):
+  # Series of random length ending at random dates, rows in random order
+  rng = np.random.RandomState(seed)
+  lengths = rng.randint(n_ds // 2, n_ds + 1, size=n_series)
+  ends = rng.randint(0, n_ds - lengths + 1) + lengths
+  uid_codes = np.repeat(np.arange(n_series), lengths)
+  ds_codes = np.concatenate([np.arange(end - length, end) for end, length in zip(ends, lengths)])
+  order = rng.permutation(len(uid_codes))
+
+  unique_ids = np.array(['id_{}'.format(i) for i in range(n_series)], dtype=object)
+  dates = pd.date_range('2000-01-01', periods=n_ds, freq='D')
+  X_df = pd.DataFrame({'unique_id': unique_ids[uid_codes[order]],
+                       'ds': dates[ds_codes[order]],
+                       'x': np.array(['a', 'b', 'c'], dtype=object)[uid_codes[order] % 3]})
+  y_df = pd.DataFrame({'unique_id': X_df['unique_id'], 'ds': X_df['ds'],
+                       'y': rng.rand(len(order))})
+  return X_df, y_df
+
+
+def measure(convert, X_df, y_df):
+  tracemalloc.start()
+  start = time.perf_counter()
+  X, y = convert(X_df, y_df)
+  elapsed = time.perf_counter() - start
+  _, peak = tracemalloc.get_traced_memory()
+  tracemalloc.stop()
+  return X, y, elapsed, peak
+
+
+def main(n_series=20000, n_ds=500):
+  X_df, y_df = make_panel(n_series, n_ds)
+  input_mb = (X_df.memory_usage(deep=True).sum() + y_df.memory_usage(deep=True).sum()) / 2**20
+  print('{} rows, {} series, {} date stamps, input frames {:.0f} MB'.format(len(X_df), n_series, n_ds, input_mb))
+
+  X_pivot, y_pivot, pivot_time, pivot_peak = measure(pivot_long_to_wide, X_df, y_df)
+  X, y, time_, peak = measure(long_to_wide, X_df, y_df)
+  assert (X == X_pivot).all()
+  assert np.array_equal(np.float32(y_pivot), y, equal_nan=True)
+
+  print('{:>10} {:>10} {:>16}'.format('', 'time (s)', 'peak memory (MB)'))
+  print('{:>10} {:>10.2f} {:>16.0f}'.format('pivot', pivot_time, pivot_peak / 2**20))
+  print('{:>10} {:>10.2f} {:>16.0f}'.format('factorize', time_, peak / 2**20))
+
+
+if __name__ == '__main__':
+  main(*[int(arg) for arg in sys.argv[1:]])
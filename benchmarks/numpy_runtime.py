@@ -0,0 +1,94 @@
+"""Cold start of a forecast worker: NumPy runtime against TorchScript and the training package.
+
+Each worker runs in a fresh interpreter, which imports its runtime, loads the
+exported model and forecasts every serie once. Reports the wall time of each
+phase and the peak RSS of the process, then the agreement and steady state
+latency of the NumPy runtime against ESRNN.predict.
+
+Usage: python benchmarks/numpy_runtime.py
+"""
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import warnings
+
+import numpy as np
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+from esrnn.contrib.ESRNN import ESRNN
+from esrnn.contrib.utils.runtime import NumpyESRNN
+from benchmarks.common import make_panel
+
+# Peak RSS from VmHWM, ru_maxrss would keep the peak of the forked benchmark process
+WORKER = """
+import sys, time, warnings
+warnings.filterwarnings('ignore')
+sys.path.insert(0, {root!r})
+start = time.perf_counter()
+{imports}
+imported = time.perf_counter()
+{load}
+loaded = time.perf_counter()
+{predict}
+predicted = time.perf_counter()
+peak = [line.split()[1] for line in open('/proc/self/status') if line.startswith('VmHWM')][0]
+print(imported - start, loaded - imported, predicted - loaded, int(peak) / 1024)
+"""
+
+WORKERS = [
+  ('python', '', '', ''),
+  ('numpy runtime', 'from esrnn.contrib.utils.runtime import NumpyESRNN',
+   'model = NumpyESRNN({npz!r})', 'model.predict()'),
+  ('torchscript', 'import torch\nfrom esrnn.contrib.utils.export import load_scripted',
+   'module, unique_ids, meta = load_scripted({pt!r})', 'module(torch.arange(len(unique_ids)))'),
+  ('training package', 'from esrnn.contrib.ESRNN import ESRNN', '', ''),
+]
+
+
+def cold_start(imports, load, predict, paths, repetitions):
+  # Best of repetitions fresh interpreters, the first one also warms the page cache
+  code = WORKER.format(root=ROOT, imports=imports, load=load.format(**paths), predict=predict)
+  runs = []
+  for r in range(repetitions + 1):
+    out = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True, check=True)
+    runs.append([float(value) for value in out.stdout.split()])
+  return np.min(runs[1:], axis=0)
+
+
+def main(n_series=2048, repetitions=3):
+  warnings.filterwarnings('ignore')
+  X_df, y_df = make_panel(n_series, n_time=120, seasonality=7, random_levels=True)
+  ids = X_df[['unique_id']].drop_duplicates()
+  model = ESRNN(max_epochs=1, batch_size=64, seasonality=7, input_size=7, output_size=14,
+                es_engine='fused', stateful_rnn=True)
+  model.fit(X_df, y_df)
+
+  with tempfile.TemporaryDirectory() as tmp:
+    paths = {'npz': os.path.join(tmp, 'esrnn.npz'), 'pt': os.path.join(tmp, 'esrnn.pt')}
+    model.export_numpy(paths['npz'])
+    model.export_torchscript(paths['pt'])
+
+    print('{:>17} {:>12} {:>10} {:>13} {:>9}'.format('worker', 'import (ms)', 'load (ms)', 'predict (ms)', 'RSS (MB)'))
+    for name, imports, load, predict in WORKERS:
+      times = cold_start(imports, load, predict, paths, repetitions)
+      print('{:>17} {:>12.1f} {:>10.1f} {:>13.1f} {:>9.1f}'.format(name, 1000*times[0], 1000*times[1],
+                                                                  1000*times[2], times[3]))
+
+    # Agreement and steady state latency against the torch model
+    runtime = NumpyESRNN(paths['npz'])
+  y_hat = model.predict(ids)['y_hat'].values.reshape(n_series, -1)
+  diff = (np.abs(runtime.predict(ids['unique_id'].values) - y_hat) / np.abs(y_hat)).max()
+  print('max rel diff against ESRNN.predict: {:.1e}'.format(diff))
+  for name, predict in [('ESRNN.predict', lambda: model.predict(ids)), ('NumpyESRNN.predict', runtime.predict)]:
+    predict()
+    start = time.perf_counter()
+    for r in range(10):
+      predict()
+    print('{} of {} series: {:.2f} ms'.format(name, n_series, 100*(time.perf_counter()-start)))
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,35 @@
+"""Holdout accuracy, predict latency and RNN size of dynamic int8 quantized inference.
+
+Usage: python benchmarks/quantized_inference.py
+"""
+import os
+import sys
+import warnings
+
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from esrnn.contrib.ESRNN import ESRNN
+from benchmarks.common import make_panel
+
+
+def main(n_series=2048, n_time=120, output_size=14, max_epochs=3):
+  warnings.filterwarnings('ignore')
+  X_df, y_df = make_panel(n_series, n_time, seasonality=7, random_levels=True)
+  train = y_df['ds'] < y_df['ds'].max() - pd.Timedelta(days=output_size - 1)
+  print('{:>6} {:>8} {:>8} {:>10} {:>11} {:>10} {:>11} {:>10} {:>11}'.format(
+        'hsize', 'stateful', 'smape', 'delta', 'float (ms)', 'int8 (ms)', 'speedup', 'float (kB)', 'int8 (kB)'))
+  for state_hsize in [40, 128]:
+    for stateful_rnn in [False, True]:
+      model = ESRNN(max_epochs=max_epochs, batch_size=64, seasonality=7, input_size=7, output_size=output_size,
+                    state_hsize=state_hsize, es_engine='fused', stateful_rnn=stateful_rnn)
+      model.fit(X_df[train], y_df[train])
+      report = model.quantization_report(y_df[~train])
+      print('{:>6} {:>8} {:>8.4f} {:>+10.1e} {:>11.2f} {:>10.2f} {:>11.2f} {:>10.1f} {:>11.1f}'.format(
+            state_hsize, str(stateful_rnn), report['float_smape'], report['smape_delta'],
+            1000*report['float_time'], 1000*report['quantized_time'], report['float_time']/report['quantized_time'],
+            report['float_size']/1024, report['quantized_size']/1024))
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,63 @@
+"""Per-batch inference latency of the exported TorchScript module against the eager path.
+
+Usage: python benchmarks/torchscript_predict.py
+"""
+import os
+import sys
+import tempfile
+import time
+import warnings
+
+import numpy as np
+import torch
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from esrnn.contrib.ESRNN import ESRNN, _take_state
+from esrnn.contrib.utils.export import load_scripted
+from benchmarks.common import make_panel
+
+
+def time_call(fn, repetitions):
+  # The TorchScript profiling executor optimizes the graph after a few calls
+  for r in range(3):
+    fn()
+  start = time.perf_counter()
+  for r in range(repetitions):
+    fn()
+  return (time.perf_counter()-start) / repetitions
+
+
+def main(n_series=2048, repetitions=50):
+  warnings.filterwarnings('ignore', category=FutureWarning)
+  X_df, y_df = make_panel(n_series, n_time=100, seasonality=7)
+  ids = X_df[['unique_id']].drop_duplicates()
+  print('{:>9} {:>7} {:>12} {:>15} {:>12} {:>8} {:>9}'.format('stateful', 'batch', 'predict (ms)', 'eager rnn (ms)',
+                                                             'script (ms)', 'speedup', 'rel diff'))
+  for stateful_rnn in [False, True]:
+    model = ESRNN(max_epochs=1, batch_size=64, seasonality=7, input_size=7, output_size=14,
+                  es_engine='fused', stateful_rnn=stateful_rnn)
+    model.fit(X_df, y_df)
+    with tempfile.TemporaryDirectory() as tmp:
+      path = os.path.join(tmp, 'esrnn.pt')
+      model.export_torchscript(path)
+      module, unique_ids, meta = load_scripted(path)
+
+    es_cache = model.get_es_cache()
+    for batch_size in [1, 64, 1024]:
+      idxs = np.arange(batch_size)
+      batch_ids = ids.iloc[:batch_size]
+      categories = model.dataloader.get_categories(idxs)
+      torch_idxs = torch.from_numpy(idxs)
+
+      eager = lambda: model._forecast(_take_state(es_cache, idxs), categories)[0]
+      scripted = lambda: module(torch_idxs)
+      times = [time_call(lambda: model.predict(batch_ids), repetitions),
+               time_call(eager, repetitions), time_call(scripted, repetitions)]
+      y_hat = eager()
+      diff = (np.abs(y_hat - scripted().numpy()) / np.abs(y_hat)).max()
+      print('{:>9} {:>7} {:>12.3f} {:>15.3f} {:>12.3f} {:>8.2f} {:>9.1e}'.format(
+            str(stateful_rnn), batch_size, 1000*times[0], 1000*times[1], 1000*times[2], times[1]/times[2], diff))
+
+
+if __name__ == '__main__':
+  main()
@@ -1,4 +1,5 @@
 import os
+import copy
 import time
 
 import numpy as np
@@ -10,9 +11,46 @@ from torch.optim.lr_scheduler import StepLR
 
 from pathlib import Path
 from esrnn.contrib.utils.config import ModelConfig
-from esrnn.contrib.utils.ESRNN import _ESRNN
-from esrnn.contrib.utils.losses import SmylLoss
-from esrnn.contrib.utils.data import Iterator
+from esrnn.contrib.utils.ESRNN import _ES, _ESRNN
+from esrnn.contrib.utils.losses import SmylLoss, PinballLoss, SMAPELoss
+from esrnn.contrib.utils.data import Iterator, Panel, Prefetcher, long_to_wide
+from esrnn.contrib.utils import distributed
+from esrnn.contrib.utils.export import save_scripted, save_bundle
+from esrnn.contrib.utils.quantization import quantize_rnn, state_dict_size
+
+
+def _es_optimizer(es, mc):
+  """Adam for the ES parameters of es, SparseAdam for row-sparse gradients with sparse_es."""
+  if mc.sparse_es:
+    return optim.SparseAdam(params=list(es.parameters()), lr=mc.learning_rate*mc.per_series_lr_multip,
+                            betas=(0.9, 0.999), eps=mc.gradient_eps)
+  return optim.Adam(params=es.parameters(), lr=mc.learning_rate*mc.per_series_lr_multip,
+                    betas=(0.9, 0.999), eps=mc.gradient_eps)
+
+
+def _take_state(state, rows):
+  """End of history state (see _ESRNN.es_state) of the series in rows."""
+  taken = dict((key, state[key][rows]) for key in ['level', 'seasonalities', 'windows'])
+  if 'rnn_states' in state:
+    taken['rnn_states'] = [(h[:, rows], c[:, rows]) for h, c in state['rnn_states']]
+  return taken
+
+
+def _put_state(state, rows, values):
+  for key in ['level', 'seasonalities', 'windows']:
+    state[key][rows] = values[key]
+  if 'rnn_states' in state:
+    for (h, c), (values_h, values_c) in zip(state['rnn_states'], values['rnn_states']):
+      h[:, rows] = values_h
+      c[:, rows] = values_c
+
+
+def _concat_state(state, other):
+  concat = dict((key, torch.cat([state[key], other[key]])) for key in ['level', 'seasonalities', 'windows'])
+  if 'rnn_states' in state:
+    concat['rnn_states'] = [(torch.cat([h, other_h], 1), torch.cat([c, other_c], 1))
+                            for (h, c), (other_h, other_c) in zip(state['rnn_states'], other['rnn_states'])]
+  return concat
 
 
 class ESRNN(object):
@@ -21,7 +59,10 @@ class ESRNN(object):
                lr_scheduler_step_size=9, noise_std=0.001, 
                level_variability_penalty=80, tau=0.5, c_state_penalty=0,
                state_hsize=40, dilations=[[1, 2], [4, 8]],
-               add_nl_layer=False, seasonality=4, input_size=4, output_size=8, frequency='D', max_periods=20, device='cpu', root_dir='./'):
+               add_nl_layer=False, seasonality=4, input_size=4, output_size=8, frequency='D', max_periods=20, device='cpu', root_dir='./',
+               es_engine='python', sparse_es=False, bucket_by_length=False, prefetch_depth=0,
+               budget_lr_schedule=False, val_freq=0, val_metric='smape', patience=3, distributed=False,
+               stateful_rnn=False, quantized_inference=False):
     super(ESRNN, self).__init__()
     self.mc = ModelConfig(max_epochs=max_epochs, batch_size=batch_size, 
                           learning_rate=learning_rate, per_series_lr_multip=per_series_lr_multip, 
@@ -31,56 +72,214 @@ class ESRNN(object):
                           c_state_penalty=c_state_penalty,
                           state_hsize=state_hsize, dilations=dilations, add_nl_layer=add_nl_layer, 
                           seasonality=seasonality, input_size=input_size, output_size=output_size,
-                          frequency=frequency, max_periods=max_periods, device=device, root_dir=root_dir)
-
-  def train(self, dataloader, random_seed):
+                          frequency=frequency, max_periods=max_periods, device=device, root_dir=root_dir,
+                          es_engine=es_engine, sparse_es=sparse_es, bucket_by_length=bucket_by_length,
+                          prefetch_depth=prefetch_depth, budget_lr_schedule=budget_lr_schedule,
+                          val_freq=val_freq, val_metric=val_metric, patience=patience,
+                          distributed=distributed, stateful_rnn=stateful_rnn,
+                          quantized_inference=quantized_inference)
+
+  def _init_es_optimizer(self):
+    self.es_optimizer = _es_optimizer(self.esrnn.es, self.mc)
+    self.es_scheduler = StepLR(optimizer=self.es_optimizer,
+                               step_size=self.mc.lr_scheduler_step_size,
+                               gamma=0.9)
+
+  def _init_rnn_optimizer(self):
+    self.rnn_optimizer = optim.Adam(params=self.esrnn.rnn.parameters(),
+                                    lr=self.mc.learning_rate,
+                                    betas=(0.9, 0.999), eps=self.mc.gradient_eps,
+                                    weight_decay=self.mc.c_state_penalty)
+
+    self.rnn_scheduler = StepLR(optimizer=self.rnn_optimizer,
+                                step_size=self.mc.lr_scheduler_step_size,
+                                gamma=0.9)
+
+  def _remap_es(self, old_dataloader):
+    """Replaces the ES parameters and their optimizer state by ones for the series of
+    self.dataloader, copied from old_dataloader rows for known unique_ids
+    and initialized for new ones. Returns the rows of new series."""
+    rows = old_dataloader.unique_id_index.get_indexer(self.dataloader.unique_idxs)
+    known = np.flatnonzero(rows >= 0)
+    old_rows = torch.from_numpy(rows[known]).to(self.mc.device)
+    known = torch.from_numpy(known).to(self.mc.device)
+
+    def grow(old_value, value):
+      value[known] = old_value[old_rows]
+      return value
+
+    es = _ES(self.mc).to(self.mc.device)
+    with torch.no_grad():
+      for param, old_param in zip(es.parameters(), self.esrnn.es.parameters()):
+        grow(old_param, param.data)
+
+    # Adam moments are per row, step counts are shared by the parameter
+    optimizer_state = self.es_optimizer.state_dict()
+    optimizer_state['state'] = {
+      key: {name: grow(value, value.new_zeros((self.dataloader.n_series,) + value.shape[1:]))
+                  if torch.is_tensor(value) and value.dim() > 0 else value
+            for name, value in param_state.items()}
+      for key, param_state in optimizer_state['state'].items()}
+    scheduler_state = self.es_scheduler.state_dict()
+
+    self.esrnn.es = es
+    self._init_es_optimizer()
+    self.es_optimizer.load_state_dict(optimizer_state)
+    self.es_scheduler.load_state_dict(scheduler_state)
+    return np.flatnonzero(rows < 0)
+
+  def _set_budget_lr(self, schedulers, epoch):
+    # Continuous version of the StepLR decay, at a fractional epoch of the budget
+    decay = 0.9 ** (epoch / self.mc.lr_scheduler_step_size)
+    for scheduler in schedulers:
+      for group, base_lr in zip(scheduler.optimizer.param_groups, scheduler.base_lrs):
+        group['lr'] = base_lr * decay
+
+  def _validate(self, dataloader, val_y, batch_size=1024):
+    """Validation loss (mc.val_metric) of the forecasts from the end of the
+    dataloader series against val_y, with shape (n_series, output_size)."""
+    n_series = dataloader.n_series
+    state = self._es_state(np.arange(n_series), batch_size, dataloader)
+    y_hat = np.zeros((n_series, self.mc.output_size), dtype=np.float32)
+    for first in range(0, n_series, batch_size):
+      last = min(first + batch_size, n_series)
+      y_hat[first:last] = self._forecast(_take_state(state, slice(first, last)),
+                                         dataloader.get_categories(np.arange(first, last)))[0]
+    self.esrnn.train()
+
+    val_loss = PinballLoss(tau=self.mc.tau) if self.mc.val_metric == 'pinball' else SMAPELoss()
+    return val_loss(val_y, torch.from_numpy(y_hat)).item()
+
+  def train(self, dataloader, random_seed, max_epochs=None, deadline=None, iterations=None, val_y=None):
+    """
+    Trains for max_epochs epochs (default mc.max_epochs), or until the wall-clock
+    deadline (a time.time() value) or the number of optimization steps in
+    iterations is reached. A cut short training restores the weights of its
+    best completed epoch. With mc.budget_lr_schedule the learning rates decay
+    along the fraction of the budget spent instead of per epoch.
+    With val_y, the next output_size values of the dataloader series, the
+    validation loss is evaluated every mc.val_freq epochs. Training stops after
+    mc.patience evaluations without improvement and the best epoch is restored.
+    With mc.distributed, processes train on their shard of series and average
+    the RNN gradients, stopping and restoring decisions are taken together.
+    """
     # print(10*'='+' Training ESRNN ' + 10*'=' + '\n')
+    max_epochs = self.mc.max_epochs if max_epochs is None else max_epochs
+    es_optimizer, es_scheduler = self.es_optimizer, self.es_scheduler
+    rnn_optimizer, rnn_scheduler = self.rnn_optimizer, self.rnn_scheduler
 
-    # Optimizers
-    es_optimizer = optim.Adam(params=self.esrnn.es.parameters(),
-                              lr=self.mc.learning_rate*self.mc.per_series_lr_multip, 
-                              betas=(0.9, 0.999), eps=self.mc.gradient_eps)
-
-    es_scheduler = StepLR(optimizer=es_optimizer,
-                          step_size=self.mc.lr_scheduler_step_size,
-                          gamma=0.9)
-
-    rnn_optimizer = optim.Adam(params=self.esrnn.rnn.parameters(),
-                               lr=self.mc.learning_rate,
-                               betas=(0.9, 0.999), eps=self.mc.gradient_eps,
-                               weight_decay=self.mc.c_state_penalty)
-
-    rnn_scheduler = StepLR(optimizer=rnn_optimizer,
-                           step_size=self.mc.lr_scheduler_step_size,
-                           gamma=0.9)
-    
     # Loss Functions
     smyl_loss = SmylLoss(tau=self.mc.tau, level_variability_penalty=self.mc.level_variability_penalty)
 
+    # Data-parallel processes step together, as many batches as the smallest shard
+    rank, world_size = distributed.get_world() if self.mc.distributed else (0, 1)
+    if world_size > 1:
+      dataloader.n_batches = int(-distributed.all_reduce_max([-dataloader.n_batches])[0])
+
+    # Batches are prepared in a background thread with prefetch_depth>0
+    prefetcher = None
+    if self.mc.prefetch_depth > 0:
+      prefetcher = Prefetcher(dataloader=dataloader, n_epochs=max_epochs,
+                              shuffle=self.shuffle, depth=self.mc.prefetch_depth)
+    batches = dataloader if prefetcher is None else prefetcher
+    self.train_stats = {'data_wait_time': 0.0, 'train_time': 0.0, 'losses': [], 'val_losses': []}
+    train_start = time.time()
+
+    # Budget
+    budgeted = (deadline is not None) or (iterations is not None)
+    max_iterations = max_epochs * dataloader.n_batches
+    start_epoch = es_scheduler.last_epoch
+    iterations_done = 0
+    has_finished = True
+    best_loss, best_state = np.inf, None
+
+    # Validation
+    validating = (val_y is not None) and (self.mc.val_freq > 0)
+    bad_evals = 0
+    self.train_stats['early_stopped'] = False
+
     # training code
-    for epoch in range(self.mc.max_epochs):
-      start = time.time()
-      if self.shuffle:
-        dataloader.shuffle_dataset(random_seed=epoch)
-      losses = []
-      for j in range(dataloader.n_batches):
-        es_optimizer.zero_grad()
-        rnn_optimizer.zero_grad()
-
-        batch = dataloader.get_batch()
-        windows_y, windows_y_hat, levels = self.esrnn(batch)
-        
-        loss = smyl_loss(windows_y, windows_y_hat, levels)
-        losses.append(loss.data.numpy())
-        loss.backward()
-        torch.nn.utils.clip_grad_norm_(self.esrnn.rnn.parameters(), self.mc.gradient_clipping_threshold)
-        torch.nn.utils.clip_grad_norm_(self.esrnn.es.parameters(), self.mc.gradient_clipping_threshold)
-        rnn_optimizer.step()
-        es_optimizer.step()
-
-      # Decay learning rate
-      es_scheduler.step()
-      rnn_scheduler.step()
+    try:
+      for epoch in range(max_epochs):
+        start = time.time()
+        if self.shuffle and prefetcher is None:
+          dataloader.shuffle_dataset(random_seed=epoch)
+        losses = []
+        for j in range(dataloader.n_batches):
+          if budgeted:
+            stop = ((deadline is not None) and (time.time() >= deadline)) or \
+                   ((iterations is not None) and (iterations_done >= iterations))
+            progress = iterations_done / max_iterations
+            if deadline is not None:
+              progress = max(progress, (time.time() - train_start) / max(deadline - train_start, 1e-9))
+            if iterations is not None:
+              progress = max(progress, iterations_done / max(iterations, 1))
+            if world_size > 1:
+              stop, progress = distributed.all_reduce_max([stop, progress])
+            if stop:
+              has_finished = False
+              break
+            if self.mc.budget_lr_schedule:
+              self._set_budget_lr([es_scheduler, rnn_scheduler], start_epoch + progress * max_epochs)
+
+          es_optimizer.zero_grad()
+          rnn_optimizer.zero_grad()
+
+          wait_start = time.time()
+          batch = batches.get_batch()
+          self.train_stats['data_wait_time'] += time.time() - wait_start
+          windows_y, windows_y_hat, levels = self.esrnn(batch)
+          
+          loss = smyl_loss(windows_y, windows_y_hat, levels)
+          losses.append(loss.data.numpy())
+          loss.backward()
+          if world_size > 1:
+            distributed.all_reduce_gradients(self.esrnn.rnn.parameters(), world_size)
+          torch.nn.utils.clip_grad_norm_(self.esrnn.rnn.parameters(), self.mc.gradient_clipping_threshold)
+          torch.nn.utils.clip_grad_norm_(self.esrnn.es.parameters(), self.mc.gradient_clipping_threshold)
+          rnn_optimizer.step()
+          es_optimizer.step()
+          iterations_done += 1
+
+        if not has_finished:
+          break
+
+        # Decay learning rate
+        es_scheduler.step()
+        rnn_scheduler.step()
+
+        epoch_loss = np.mean(losses)
+        if world_size > 1:
+          epoch_loss = distributed.all_reduce_mean(epoch_loss, len(losses))
+        self.train_stats['losses'].append(epoch_loss)
+
+        # Best epoch by validation loss, or by train loss when only the budget may cut training
+        if validating:
+          if ((epoch + 1) % self.mc.val_freq == 0) or (epoch == max_epochs - 1):
+            val_loss = self._validate(dataloader, val_y)
+            if world_size > 1:
+              val_loss = distributed.all_reduce_mean(val_loss, dataloader.n_series)
+            self.train_stats['val_losses'].append(val_loss)
+            if val_loss < best_loss:
+              best_loss, bad_evals = val_loss, 0
+              best_state = copy.deepcopy(self.esrnn.state_dict())
+            else:
+              bad_evals += 1
+            if bad_evals >= self.mc.patience:
+              self.train_stats['early_stopped'] = True
+              break
+        elif budgeted and epoch_loss < best_loss:
+          best_loss = epoch_loss
+          best_state = copy.deepcopy(self.esrnn.state_dict())
+    finally:
+      if prefetcher is not None:
+        prefetcher.close()
+
+    if (validating or not has_finished) and best_state is not None:
+      self.esrnn.load_state_dict(best_state)
+    self.train_stats['train_time'] = time.time() - train_start
+    self.train_stats['has_finished'] = has_finished
+    self.train_stats['iterations_done'] = iterations_done
 
     #   print("========= Epoch {} finished =========".format(epoch))
     #   print("Training time: {}".format(time.time()-start))
@@ -88,7 +287,18 @@ class ESRNN(object):
     #
     # print('Train finished!')
   
-  def fit(self, X_df, y_df, shuffle=True, random_seed=1):
+  def fit(self, X_df, y_df, shuffle=True, random_seed=1, warm_start=False, max_epochs=None,
+          timeout=None, iterations=None):
+    """
+    Fits the model on long X_df and y_df.
+    With warm_start a fitted model resumes from its RNN weights, the ES parameters
+    of known unique_ids and the optimizers state, and trains max_epochs
+    (default mc.max_epochs) more epochs. New series are initialized as usual,
+    new categories raise a ValueError.
+    timeout (seconds, from the call) and iterations (optimization steps) bound
+    the training, train_stats['has_finished'] tells whether it was cut short.
+    """
+    deadline = None if timeout is None else time.time() + timeout
     # Transform long dfs to wide numpy
     assert type(X_df) == pd.core.frame.DataFrame
     assert type(y_df) == pd.core.frame.DataFrame
@@ -99,29 +309,169 @@ class ESRNN(object):
     assert len(X)==len(y)
     assert X.shape[1]>=3
 
+    self.fit_panel(Panel.from_wide(X, y), shuffle=shuffle, random_seed=random_seed,
+                   warm_start=warm_start, max_epochs=max_epochs, iterations=iterations,
+                   timeout=None if deadline is None else deadline - time.time())
+
+  def fit_panel(self, panel, shuffle=True, random_seed=1, warm_start=False, max_epochs=None,
+                timeout=None, iterations=None):
+    """Fits on a Panel, or on the directory of a panel written with
+    write_panel or write_panel_csv, read through np.memmap.
+    Other arguments as in fit."""
+    deadline = None if timeout is None else time.time() + timeout
+    if not isinstance(panel, Panel):
+      panel = Panel.load(panel)
+    warm_start = warm_start and hasattr(self, 'esrnn')
+
     # Exogenous variables
-    unique_categories = np.unique(X[:, 1])
-    self.mc.category_to_idx = dict((word, index) for index, word in enumerate(unique_categories))
-    self.mc.exogenous_size = len(unique_categories)
+    unique_categories = np.unique(panel.categories)
+    if warm_start:
+      if not all([(category in self.mc.category_to_idx) for category in unique_categories]):
+        raise ValueError("warm_start does not support new categories")
+    else:
+      self.mc.category_to_idx = dict((word, index) for index, word in enumerate(unique_categories))
+      self.mc.exogenous_size = len(unique_categories)
+
+    # Data-parallel shard, every world_size-th serie from rank
+    rank, world_size = distributed.get_world() if self.mc.distributed else (0, 1)
+    train_panel = panel
+    if world_size > 1:
+      train_panel = panel.take(np.arange(rank, panel.n_series, world_size))
+
+    # Validation holdout, the last output_size observations of each serie
+    val_y = None
+    if self.mc.val_freq > 0:
+      val_y = train_panel.get_last_y(np.arange(train_panel.n_series), self.mc.output_size)
+      train_panel = train_panel.holdout(self.mc.output_size, self.mc.frequency)
+      assert train_panel.lengths.min() >= self.mc.min_series_length, \
+             "series too short for a validation holdout of output_size"
 
     # Create batches (device in mc)
-    self.dataloader = Iterator(mc=self.mc, X=X, y=y)
+    old_dataloader = self.dataloader if warm_start else None
+    self.dataloader = Iterator(mc=self.mc, panel=train_panel)
     self.shuffle = shuffle
 
     # Random Seeds (model initialization)
     torch.manual_seed(random_seed)
     np.random.seed(random_seed)
 
-    # Initialize model
+    # Initialize model, or resume from the fitted one
     self.mc.n_series = self.dataloader.n_series
-    self.esrnn = _ESRNN(self.mc).to(self.mc.device)
+    if warm_start:
+      self._remap_es(old_dataloader)
+    else:
+      self.esrnn = _ESRNN(self.mc).to(self.mc.device)
+      if world_size > 1:
+        distributed.broadcast_parameters(self.esrnn.rnn.parameters())
+      self._init_es_optimizer()
+      self._init_rnn_optimizer()
 
     # Train model
-    self.train(dataloader=self.dataloader, random_seed=random_seed)
+    self.train(dataloader=self.dataloader, random_seed=random_seed, max_epochs=max_epochs,
+               deadline=deadline, iterations=iterations, val_y=val_y)
+
+    # Forecasts start from the full history, of every serie
+    if world_size > 1:
+      self._gather_es(panel)
+    elif val_y is not None:
+      self.dataloader = Iterator(mc=self.mc, panel=panel)
+    # Under a budget the cache is left to the first forecast, see get_es_cache
+    if deadline is None and iterations is None:
+      self.build_es_cache()
+    else:
+      self.es_cache = None
+
+  def _gather_es(self, panel):
+    """Collects the ES parameters trained by every process into tables for all
+    the series of panel. ES optimizer moments are kept for the own shard only."""
+    shard = (self.dataloader.unique_idxs, [param.detach().cpu() for param in self.esrnn.es.parameters()])
+    shards = distributed.all_gather_object(shard)
 
-  def predict(self, X_df, decomposition=False):
+    old_dataloader = self.dataloader
+    self.dataloader = Iterator(mc=self.mc, panel=panel)
+    self.mc.n_series = self.dataloader.n_series
+    self._remap_es(old_dataloader)
+    with torch.no_grad():
+      for unique_idxs, shard_params in shards:
+        rows = torch.from_numpy(self.dataloader.get_idxs(unique_idxs)).to(self.mc.device)
+        for param, shard_param in zip(self.esrnn.es.parameters(), shard_params):
+          param[rows] = shard_param.to(self.mc.device)
+
+  def add_series(self, X_df, y_df, max_epochs=5, shuffle=True, random_seed=1):
+    """
+    Adds series not seen in fit to a fitted model, without retraining it.
+    Only the ES parameters of the new series are trained, for max_epochs
+    epochs through the frozen RNN, and they are available to predict
+    right after. Categories of the new series must be known to the model.
+    The data of a model fitted on an on-disk panel stays memory-mapped and
+    its directory is left as is, the new series are kept in memory (see Panel.concat).
+    """
+    assert type(X_df) == pd.core.frame.DataFrame
+    assert type(y_df) == pd.core.frame.DataFrame
+    assert all([(col in X_df) for col in ['unique_id', 'ds', 'x']])
+    assert all([(col in y_df) for col in ['unique_id', 'ds', 'y']])
+
+    X, y = self.long_to_wide(X_df, y_df)
+    panel = Panel.from_wide(X, y)
+    assert not self.dataloader.unique_id_index.isin(panel.unique_idxs).any(), "unique_id already fitted"
+    assert all([(category in self.mc.category_to_idx) for category in np.unique(panel.categories)]), \
+           "add_series does not support new categories"
+    es_cache = self.es_cache if self._is_es_cache_valid() else None
+
+    # New series ES parameters, trained against the shared RNN with its weights frozen
+    mc = copy.copy(self.mc)
+    mc.n_series = panel.n_series
+    # Length buckets cover every serie in each epoch, also the remainder of batch_size
+    mc.batch_size = min(self.mc.batch_size, panel.n_series)
+    mc.bucket_by_length = True
+    dataloader = Iterator(mc=mc, panel=panel)
+    torch.manual_seed(random_seed)
+    np.random.seed(random_seed)
+    esrnn = _ESRNN(mc, rnn=self.esrnn.rnn).to(mc.device)
+    new_es = esrnn.es
+    es_optimizer = _es_optimizer(new_es, mc)
+    smyl_loss = SmylLoss(tau=mc.tau, level_variability_penalty=mc.level_variability_penalty)
+
+    requires_grad = [param.requires_grad for param in esrnn.rnn.parameters()]
+    esrnn.rnn.requires_grad_(False)
+    try:
+      for epoch in range(max_epochs):
+        if shuffle:
+          dataloader.shuffle_dataset(random_seed=epoch)
+        for j in range(dataloader.n_batches):
+          es_optimizer.zero_grad()
+          windows_y, windows_y_hat, levels = esrnn(dataloader.get_batch())
+          loss = smyl_loss(windows_y, windows_y_hat, levels)
+          loss.backward()
+          torch.nn.utils.clip_grad_norm_(new_es.parameters(), mc.gradient_clipping_threshold)
+          es_optimizer.step()
+    finally:
+      for param, param_requires_grad in zip(esrnn.rnn.parameters(), requires_grad):
+        param.requires_grad_(param_requires_grad)
+
+    # Append the new series to the data and to the ES tables
+    old_dataloader = self.dataloader
+    self.dataloader = Iterator(mc=self.mc, panel=Panel.concat([old_dataloader.panel, panel]))
+    self.mc.n_series = self.dataloader.n_series
+    new_rows = self._remap_es(old_dataloader)
+    with torch.no_grad():
+      for param, new_param in zip(self.esrnn.es.parameters(), new_es.parameters()):
+        param[torch.from_numpy(new_rows).to(self.mc.device)] = new_param
+
+    # Extend the ES state cache with the new series only
+    if es_cache is None:
+      self.build_es_cache()
+    else:
+      self.es_cache = _concat_state(es_cache, self._es_state(new_rows))
+      self.es_cache['key'] = self._es_cache_key()
+      self.es_cache['last_ds'] = np.concatenate([es_cache['last_ds'], self.dataloader.last_ds[new_rows]])
+
+  def predict(self, X_df, decomposition=False, batch_size=1024):
     """
         Predictions for all stored time series
+    Forecasts start from the cached end of history ES state of each serie,
+    one RNN pass per batch of at most batch_size series, through the
+    int8 quantized RNN with mc.quantized_inference.
     Returns:
         Y_hat_panel : array-like (n_samples, 1).
             Predicted values for models in Family for ids in Panel.
@@ -133,67 +483,239 @@ class ESRNN(object):
 
     # Obtain unique_ids to predict
     predict_unique_idxs = X_df['unique_id'].unique()
+    idxs = self.dataloader.get_idxs(predict_unique_idxs)
+    output_size = self.mc.output_size
+    es_cache = self.get_es_cache()
 
     # Predictions for panel
-    Y_hat_panel = pd.DataFrame(columns=['unique_id', 'y_hat'])
+    y_hat, trends, seasonalities, level = self._forecast_idxs(es_cache, idxs, batch_size,
+                                                              quantized=self.mc.quantized_inference)
 
-    for unique_id in predict_unique_idxs:
-      # Corresponding train batch
-      batch = self.dataloader.get_batch(unique_id=unique_id)
+    Y_hat_panel = pd.DataFrame({'unique_id': np.repeat(predict_unique_idxs, output_size),
+                                'y_hat': y_hat.ravel()})
+    if decomposition:
+      Y_hat_panel['trend'] = trends.ravel()
+      Y_hat_panel['seasonalities'] = seasonalities.ravel()
+      Y_hat_panel['level'] = np.repeat(level.ravel(), output_size)
+    Y_hat_panel['ds'] = self._forecast_ds(es_cache['last_ds'][idxs])
 
-      # Prediction
-      if decomposition:
-        Y_hat_id = pd.DataFrame(np.zeros(shape=(self.mc.output_size, 4)), columns=["y_hat", "trend", "seasonalities", "level"])
-        y_hat, trends, seasonalities, level = self.esrnn.predict(batch)
-      else:
-        Y_hat_id = pd.DataFrame(np.zeros(shape=(self.mc.output_size, 1)), columns=["y_hat"])
-        y_hat, _, _, _ = self.esrnn.predict(batch)
+    if 'ds' in X_df:
+      Y_hat_panel = X_df.merge(Y_hat_panel, on=['unique_id', 'ds'], how='left')
 
-      y_hat = y_hat.squeeze()
-      Y_hat_id.iloc[:, 0] = y_hat
+    return Y_hat_panel
 
-      # Serie prediction
-      Y_hat_id["unique_id"] = unique_id
-      ts = date_range = pd.date_range(start=batch.last_ds[0],
-                                      periods=self.mc.output_size+1, freq=self.mc.frequency)
-      Y_hat_id["ds"] = ts[1:]
+  def _forecast_ds(self, last_ds):
+    """Forecast date stamps of series ending at last_ds, flat in (serie, step) order."""
+    if len(last_ds) == 0:
+      return np.array([], dtype='datetime64[ns]')
+
+    # One date_range per distinct last date
+    last_ds_codes, unique_last_ds = pd.factorize(last_ds)
+    ds = np.stack([pd.date_range(start=start, periods=self.mc.output_size+1, freq=self.mc.frequency)[1:].values
+                   for start in unique_last_ds])
+    return ds[last_ds_codes].ravel()
+
+  def _forecast_idxs(self, es_cache, idxs, batch_size=1024, quantized=False):
+    """Forecasts and decomposition of the series in idxs from their cached state, in batches."""
+    n_series = len(idxs)
+    output_size = self.mc.output_size
+    y_hat = np.zeros((n_series, output_size), dtype=np.float32)
+    trends = np.zeros((n_series, output_size), dtype=np.float32)
+    seasonalities = np.zeros((n_series, output_size), dtype=np.float32)
+    level = np.zeros((n_series, 1), dtype=np.float32)
+    for first in range(0, n_series, batch_size):
+      last = min(first + batch_size, n_series)
+      batch_idxs = idxs[first:last]
+      y_hat[first:last], trends[first:last], seasonalities[first:last], level[first:last] = \
+        self._forecast(_take_state(es_cache, batch_idxs), self.dataloader.get_categories(batch_idxs), quantized)
+    return y_hat, trends, seasonalities, level
+
+  def _forecast(self, state, categories, quantized=False):
+    rnn = self._get_quantized_rnn() if quantized else None
+    return self.esrnn.predict_from_state(state['level'], state['seasonalities'], state['windows'],
+                                         categories, state.get('rnn_states'), rnn=rnn)
+
+  def _get_quantized_rnn(self):
+    """Dynamic int8 copy of the RNN, requantized when its parameters changed since."""
+    key = [(param, param._version) for param in self.esrnn.rnn.parameters()]
+    cached = getattr(self, 'quantized_rnn', None)
+    if cached is None or len(cached[0]) != len(key) or \
+       not all([(param is cached_param) and (version == cached_version)
+                for (param, version), (cached_param, cached_version) in zip(key, cached[0])]):
+      self.quantized_rnn = (key, quantize_rnn(self.esrnn.rnn))
+    return self.quantized_rnn[1]
+
+  def quantization_report(self, y_df, batch_size=1024, repetitions=5):
+    """
+    Compares the float and the dynamic int8 quantized RNN (mc.quantized_inference)
+    on a holdout, to choose the inference mode per deployment.
+    y_df: long df with columns unique_id, ds and y, the observations after
+    the last date of stored series.
+    Returns a dict with the holdout smape of both modes and its delta, the
+    seconds to forecast the holdout series (best of repetitions) and the
+    bytes of the serialized RNN weights.
+    """
+    assert type(y_df) == pd.core.frame.DataFrame
+    assert all([(col in y_df) for col in ['unique_id', 'ds', 'y']])
 
-      if decomposition:
-        Y_hat_id["trend"] = trends.squeeze()
-        Y_hat_id["seasonalities"] = seasonalities.squeeze()
-        Y_hat_id["level"] = level.squeeze()
+    unique_ids = y_df['unique_id'].unique()
+    idxs = self.dataloader.get_idxs(unique_ids)
+    es_cache = self.get_es_cache()
+    ds = self._forecast_ds(es_cache['last_ds'][idxs])
+
+    report = {}
+    for mode, quantized in [('float', False), ('quantized', True)]:
+      self._forecast_idxs(es_cache, idxs[:1], batch_size, quantized)
+      times = []
+      for r in range(repetitions):
+        start = time.time()
+        y_hat = self._forecast_idxs(es_cache, idxs, batch_size, quantized)[0]
+        times.append(time.time() - start)
+
+      Y_hat_panel = pd.DataFrame({'unique_id': np.repeat(unique_ids, self.mc.output_size),
+                                  'ds': ds, 'y_hat': y_hat.ravel()})
+      Y_hat_panel = y_df.merge(Y_hat_panel, on=['unique_id', 'ds'], how='inner')
+      y = torch.tensor(Y_hat_panel['y'].values, dtype=torch.float32)
+      report[mode + '_smape'] = SMAPELoss()(y, torch.tensor(Y_hat_panel['y_hat'].values)).item()
+      report[mode + '_time'] = min(times)
+    report['smape_delta'] = report['quantized_smape'] - report['float_smape']
+    report['float_size'] = state_dict_size(self.esrnn.rnn)
+    report['quantized_size'] = state_dict_size(self._get_quantized_rnn())
+    return report
+
+  def _es_cache_key(self):
+    # Data and in-place versions of the parameters the cache was computed from
+    params = list(self.esrnn.es.parameters())
+    if self.mc.stateful_rnn:
+      params += list(self.esrnn.rnn.parameters())
+    return [self.dataloader] + [(param, param._version) for param in params]
+
+  def _is_es_cache_valid(self):
+    if getattr(self, 'es_cache', None) is None:
+      return False
+    key, cached_key = self._es_cache_key(), self.es_cache['key']
+    return len(key) == len(cached_key) and key[0] is cached_key[0] and \
+           all([(param is cached_param) and (version == cached_version)
+                for (param, version), (cached_param, cached_version) in zip(key[1:], cached_key[1:])])
+
+  def _es_state(self, idxs, batch_size=1024, dataloader=None):
+    """End of history state (see _ESRNN.es_state) of the series in idxs of
+    dataloader (default self.dataloader), computed over their full history
+    in batches of series with equal length."""
+    dataloader = self.dataloader if dataloader is None else dataloader
+    n_series = len(idxs)
+    state = {'level': torch.zeros((n_series, 1)),
+             'seasonalities': torch.zeros((n_series, self.mc.seasonality)),
+             'windows': torch.zeros((n_series, self.mc.input_size))}
+    if self.mc.stateful_rnn:
+      state['rnn_states'] = [(torch.zeros((dilation, n_series, cell.hidden_size)),
+                              torch.zeros((dilation, n_series, cell.hidden_size)))
+                             for layer in self.esrnn.rnn.rnn_stack
+                             for cell, dilation in zip(layer.cells, layer.dilations)]
+
+    self.esrnn.eval()
+    with torch.no_grad():
+      for positions in dataloader.length_batches(idxs, batch_size):
+        batch = dataloader.get_idxs_batch(idxs[positions])
+        _put_state(state, positions, self.esrnn.es_state(batch))
+    return state
+
+  def build_es_cache(self, batch_size=1024):
+    """Stores the end of history state of every fitted serie, with
+    mc.stateful_rnn also the RNN states after its history."""
+    self.es_cache = self._es_state(np.arange(self.dataloader.n_series), batch_size)
+    self.es_cache['key'] = self._es_cache_key()
+    self.es_cache['last_ds'] = self.dataloader.last_ds.copy()
+
+  def get_es_cache(self):
+    """ES state cache, recomputed when the data or the ES parameters changed since it was built."""
+    if not self._is_es_cache_valid():
+      self.build_es_cache()
+    return self.es_cache
+
+  def update(self, X_df, y_df):
+    """
+    Advances the cached ES state of fitted series over new observations,
+    with the learned smoothing coefficients and without retraining.
+    X_df and y_df are long dfs as in fit, holding only dates after the
+    last date of each serie. The dataloader history is not extended, so
+    a rebuilt cache (e.g. after training again) drops the updates.
+    """
+    assert type(X_df) == pd.core.frame.DataFrame
+    assert type(y_df) == pd.core.frame.DataFrame
+    assert all([(col in X_df) for col in ['unique_id', 'ds', 'x']])
+    assert all([(col in y_df) for col in ['unique_id', 'ds', 'y']])
 
-      Y_hat_panel = Y_hat_panel.append(Y_hat_id, sort=False).reset_index(drop=True)
+    X, y = self.long_to_wide(X_df, y_df)
+    idxs = self.dataloader.get_idxs(X[:, 0])
+    es_cache = self.get_es_cache()
+
+    first_ds = X_df.groupby('unique_id', sort=True)['ds'].min()
+    assert (pd.to_datetime(first_ds.values) > pd.to_datetime(es_cache['last_ds'][idxs])).all(), \
+           "update expects dates after the last date of each serie"
+
+    with torch.no_grad():
+      lev_sms = self.esrnn.es.logistic(self.esrnn.es.lev_sms[idxs, 0])
+      seas_sms = self.esrnn.es.logistic(self.esrnn.es.seas_sms[idxs, 0])
+      state = _take_state(es_cache, idxs)
+      level = state['level'][:, 0]
+      seasonalities = state['seasonalities']
+      windows = state['windows']
+      rnn_states = state.get('rnn_states')
+      categories = self.dataloader.get_categories(idxs)
+
+      # Holt-Winters recursion over the new dates only, series without an
+      # observation at a date keep their state
+      y = torch.from_numpy(y)
+      for t in range(y.shape[1]):
+        observed = ~torch.isnan(y[:, t])
+        y_t = torch.where(observed, y[:, t], level * seasonalities[:, 0])
+        deseasonalized = y_t / seasonalities[:, 0]
+        newlev = lev_sms * deseasonalized + (1-lev_sms) * level
+        newseason = seas_sms * (y_t / newlev) + (1-seas_sms) * seasonalities[:, 0]
+
+        # The stateful RNN moves past the input window that ends before the new
+        # observation, normalized by the new level as in training
+        if rnn_states is not None:
+          new_rnn_states = self.esrnn.rnn_step(windows, newlev[:, None], categories, rnn_states)
+          rnn_states = [(torch.where(observed[None, :, None], new_h, h), torch.where(observed[None, :, None], new_c, c))
+                        for (h, c), (new_h, new_c) in zip(rnn_states, new_rnn_states)]
+
+        level = torch.where(observed, newlev, level)
+        seasonalities = torch.where(observed[:, None],
+                                    torch.cat([seasonalities[:, 1:], newseason[:, None]], 1), seasonalities)
+        windows = torch.where(observed[:, None],
+                              torch.cat([windows[:, 1:], deseasonalized[:, None]], 1), windows)
+
+    state = {'level': level[:, None], 'seasonalities': seasonalities, 'windows': windows}
+    if rnn_states is not None:
+      state['rnn_states'] = rnn_states
+    _put_state(es_cache, idxs, state)
+    es_cache['last_ds'][idxs] = X[:, 2]
+
+  def export_torchscript(self, path):
+    """
+    Writes the forecasts of the stored series as a single TorchScript module,
+    with the ES state of every serie baked in, to be served with
+    esrnn.contrib.utils.export.load_scripted without the training code.
+    """
+    es_cache = self.get_es_cache()
+    categories = self.dataloader.get_categories(np.arange(self.dataloader.n_series))
+    save_scripted(path, self.esrnn, es_cache, categories, unique_ids=self.dataloader.unique_idxs,
+                  frequency=self.mc.frequency)
 
-    if 'ds' in X_df:
-      Y_hat_panel = X_df.merge(Y_hat_panel, on=['unique_id', 'ds'], how='left')
+  def export_numpy(self, path):
+    """
+    Writes the weights and the ES state of the stored series as a .npz bundle,
+    to be served by esrnn.contrib.utils.runtime.NumpyESRNN without torch.
+    """
+    es_cache = self.get_es_cache()
+    categories = self.dataloader.get_categories(np.arange(self.dataloader.n_series))
+    save_bundle(path, self.esrnn, es_cache, categories, unique_ids=self.dataloader.unique_idxs,
+                frequency=self.mc.frequency)
 
-    return Y_hat_panel
-  
   def long_to_wide(self, X_df, y_df):
-    data = X_df.copy()
-    data['y'] = y_df['y'].copy()
-    sorted_ds = np.sort(data['ds'].unique())
-    ds_map = {}
-    for dmap, t in enumerate(sorted_ds):
-        ds_map[t] = dmap
-    data['ds_map'] = data['ds'].map(ds_map)
-    data = data.sort_values(by=['ds_map','unique_id'])
-    df_wide = data.pivot(index='unique_id', columns='ds_map')['y']
-    
-    x_unique = data[['unique_id', 'x']].groupby('unique_id').first()
-    last_ds =  data[['unique_id', 'ds']].groupby('unique_id').last()
-    assert len(x_unique)==len(data.unique_id.unique())
-    df_wide['x'] = x_unique
-    df_wide['last_ds'] = last_ds
-    df_wide = df_wide.reset_index().rename_axis(None, axis=1)
-    
-    ds_cols = data.ds_map.unique().tolist()
-    X = df_wide.filter(items=['unique_id', 'x', 'last_ds']).values
-    y = df_wide.filter(items=ds_cols).values
-
-    # TODO: assert "completeness" of the series (frequency-wise)
-    return X, y
+    return long_to_wide(X_df, y_df)
 
   def get_dir_name(self, root_dir=None):
     if not root_dir:
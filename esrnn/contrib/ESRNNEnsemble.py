@@ -0,0 +1,133 @@
+import os
+
+import numpy as np
+import pandas as pd
+
+import torch
+import torch.multiprocessing as mp
+
+from esrnn.contrib.ESRNN import ESRNN, _take_state
+from esrnn.contrib.utils.ESRNN import _ESRNN
+from esrnn.contrib.utils.data import Iterator, Panel, long_to_wide
+
+
+def _init_worker(n_threads):
+  # Cores of the box are split between the members trained at once
+  torch.set_num_threads(n_threads)
+
+
+def _fit_member(task):
+  """Fits one member, returns what the ensemble needs to predict with it."""
+  kwargs, panel, shuffle, random_seed = task
+  member = ESRNN(**kwargs)
+  member.fit_panel(panel, shuffle=shuffle, random_seed=random_seed)
+  es_cache = dict((key, value) for key, value in member.get_es_cache().items() if key != 'key')
+  return member.mc, member.esrnn.state_dict(), es_cache, member.train_stats
+
+
+class ESRNNEnsemble(object):
+  """
+  Ensemble of ESRNN models that differ in their random_seed.
+  The panel is converted once and shared by the members, which are
+  trained in a pool of n_jobs processes (default one per core).
+  n_members: number of models.
+  combination: 'median' or 'mean' of the member forecasts.
+  kwargs: ESRNN arguments, the same for every member.
+  """
+  def __init__(self, n_members=5, combination='median', n_jobs=None, **kwargs):
+    assert combination in ['median', 'mean'], "combination must be 'median' or 'mean'"
+    self.n_members = n_members
+    self.combination = combination
+    self.n_jobs = n_jobs
+    self.kwargs = kwargs
+
+  def fit(self, X_df, y_df, shuffle=True, random_seed=1):
+    # Transform long dfs to wide numpy, once for all the members
+    assert type(X_df) == pd.core.frame.DataFrame
+    assert type(y_df) == pd.core.frame.DataFrame
+    assert all([(col in X_df) for col in ['unique_id', 'ds', 'x']])
+    assert all([(col in y_df) for col in ['unique_id', 'ds', 'y']])
+
+    X, y = long_to_wide(X_df, y_df)
+    self.fit_panel(Panel.from_wide(X, y), shuffle=shuffle, random_seed=random_seed)
+
+  def fit_panel(self, panel, shuffle=True, random_seed=1):
+    """Fits the members on a Panel, or on the directory of an on-disk panel,
+    which every process then memory-maps. Member k uses random_seed + k."""
+    path = None
+    if not isinstance(panel, Panel):
+      path, panel = panel, Panel.load(panel)
+
+    n_jobs = min(self.n_jobs or os.cpu_count(), self.n_members)
+    tasks = [(self.kwargs, panel if path is None else path, shuffle, random_seed + k)
+             for k in range(self.n_members)]
+    if n_jobs == 1:
+      results = [_fit_member(task) for task in tasks]
+    else:
+      # Workers receive a handle to the values in shared memory, not a copy
+      if path is None:
+        panel.values.share_memory_()
+        if panel.tail is not None:
+          panel.tail.share_memory_()
+      pool = mp.get_context('spawn').Pool(n_jobs, initializer=_init_worker,
+                                          initargs=(max(1, os.cpu_count() // n_jobs),))
+      try:
+        results = pool.map(_fit_member, tasks, chunksize=1)
+      finally:
+        pool.close()
+        pool.join()
+
+    # Members share one dataloader over the panel
+    self.members = []
+    self.dataloader = None
+    for mc, state_dict, es_cache, train_stats in results:
+      if self.dataloader is None:
+        self.dataloader = Iterator(mc=mc, panel=panel)
+      member = ESRNN(**self.kwargs)
+      member.mc = mc
+      member.dataloader = self.dataloader
+      member.esrnn = _ESRNN(mc).to(mc.device)
+      member.esrnn.load_state_dict(state_dict)
+      member.train_stats = train_stats
+      es_cache['key'] = member._es_cache_key()
+      member.es_cache = es_cache
+      self.members.append(member)
+
+  def predict(self, X_df, batch_size=1024):
+    """
+        Combined predictions of the members for all stored time series
+    Returns:
+        Y_hat_panel : DataFrame with columns unique_id, y_hat and ds,
+            merged into X_df when it has a ds column.
+    """
+    assert type(X_df) == pd.core.frame.DataFrame
+    assert 'unique_id' in X_df
+
+    predict_unique_idxs = X_df['unique_id'].unique()
+    idxs = self.dataloader.get_idxs(predict_unique_idxs)
+    n_series = len(idxs)
+    output_size = self.members[0].mc.output_size
+    es_caches = [member.get_es_cache() for member in self.members]
+
+    # Forecasts of every member, one batch of series at a time
+    y_hat = np.zeros((self.n_members, n_series, output_size), dtype=np.float32)
+    for first in range(0, n_series, batch_size):
+      last = min(first + batch_size, n_series)
+      batch_idxs = idxs[first:last]
+      categories = self.dataloader.get_categories(batch_idxs)
+      for k, (member, es_cache) in enumerate(zip(self.members, es_caches)):
+        y_hat[k, first:last] = member._forecast(_take_state(es_cache, batch_idxs), categories,
+                                                member.mc.quantized_inference)[0]
+    if self.combination == 'median':
+      y_hat = np.median(y_hat, axis=0)
+    else:
+      y_hat = np.mean(y_hat, axis=0)
+
+    Y_hat_panel = pd.DataFrame({'unique_id': np.repeat(predict_unique_idxs, output_size),
+                                'y_hat': y_hat.ravel()})
+    Y_hat_panel['ds'] = self.members[0]._forecast_ds(es_caches[0]['last_ds'][idxs])
+
+    if 'ds' in X_df:
+      Y_hat_panel = X_df.merge(Y_hat_panel, on=['unique_id', 'ds'], how='left')
+
+    return Y_hat_panel
@@ -51,6 +51,48 @@ class DRNN(nn.Module):
             inputs = inputs.transpose(0, 1)
         return inputs, outputs
 
+    def forward_states(self, inputs, states=None):
+        """
+        Runs inputs with shape (n_steps, batch, features) from states and returns the
+        outputs of the last layer and the states after the last step, LSTM only.
+        states: per layer, (h, c) tensors with shape (rate, batch, hidden) of the
+        rate dilated chains, ring ordered so that slot j is continued by the
+        j-th next step (mod rate). None starts from zeros.
+        """
+        assert self.cell_type == 'LSTM' and not self.batch_first
+        new_states = []
+        for i, (cell, dilation) in enumerate(zip(self.cells, self.dilations)):
+            inputs, state = self._drnn_layer_states(cell, inputs, dilation, None if states is None else states[i])
+            new_states.append(state)
+        return inputs, new_states
+
+    def _drnn_layer_states(self, cell, inputs, rate, state):
+        n_steps, batch_size = inputs.size(0), inputs.size(1)
+        hidden_size = cell.hidden_size
+        if state is None:
+            zeros = inputs.new_zeros(rate, batch_size, hidden_size)
+            state = (zeros, zeros)
+        h, c = [s.reshape(1, rate * batch_size, hidden_size) for s in state]
+
+        # Whole dilated steps, then the remaining steps continue the first chains only,
+        # so no padding step moves the states
+        full_steps, remainder = divmod(n_steps, rate)
+        outputs = [inputs.new_zeros(0, batch_size, hidden_size)]
+        if full_steps > 0:
+            dilated_outputs, (h, c) = cell(self._prepare_inputs(inputs[:full_steps * rate], rate), (h, c))
+            outputs.append(self._split_outputs(dilated_outputs, rate))
+        if remainder > 0:
+            n = remainder * batch_size
+            dilated_outputs, (h_r, c_r) = cell(self._prepare_inputs(inputs[full_steps * rate:], remainder),
+                                               (h[:, :n].contiguous(), c[:, :n].contiguous()))
+            outputs.append(self._split_outputs(dilated_outputs, remainder))
+            # The chain of the next step comes first
+            h = torch.cat((h[:, n:], h_r), 1)
+            c = torch.cat((c[:, n:], c_r), 1)
+
+        state = (h.reshape(rate, batch_size, hidden_size), c.reshape(rate, batch_size, hidden_size))
+        return torch.cat(outputs), state
+
     def drnn_layer(self, cell, inputs, rate, hidden=None):
 
         n_steps = len(inputs)
@@ -73,13 +115,7 @@ class DRNN(nn.Module):
         return outputs, hidden
 
     def _apply_cell(self, dilated_inputs, cell, batch_size, rate, hidden_size, hidden=None):
-        if hidden is None:
-            if self.cell_type == 'LSTM':
-                c, m = self.init_hidden(batch_size * rate, hidden_size)
-                hidden = (c.unsqueeze(0), m.unsqueeze(0))
-            else:
-                hidden = self.init_hidden(batch_size * rate, hidden_size).unsqueeze(0)
-
+        # Without a hidden state the cell starts from zeros, as init_hidden
         dilated_outputs, hidden = cell(dilated_inputs, hidden)
 
         return dilated_outputs, hidden
@@ -88,14 +124,11 @@ class DRNN(nn.Module):
         return splitted_outputs[:n_steps]
 
     def _split_outputs(self, dilated_outputs, rate):
+        # (dilated_steps, rate * batch, hidden) -> (dilated_steps * rate, batch, hidden), a view
         batchsize = dilated_outputs.size(1) // rate
-
-        blocks = [dilated_outputs[:, i * batchsize: (i + 1) * batchsize, :] for i in range(rate)]
-
-        interleaved = torch.stack((blocks)).transpose(1, 0).contiguous()
-        interleaved = interleaved.view(dilated_outputs.size(0) * rate,
-                                       batchsize,
-                                       dilated_outputs.size(2))
+        interleaved = dilated_outputs.reshape(dilated_outputs.size(0) * rate,
+                                              batchsize,
+                                              dilated_outputs.size(2))
         return interleaved
 
     def _pad_inputs(self, inputs, n_steps, rate):
@@ -103,21 +136,30 @@ class DRNN(nn.Module):
 
         if not iseven:
             dilated_steps = n_steps // rate + 1
-
-            zeros_ = torch.zeros(dilated_steps * rate - inputs.size(0),
-                                 inputs.size(1),
-                                 inputs.size(2))
-            if use_cuda:
-                zeros_ = zeros_.cuda()
-
-            inputs = torch.cat((inputs, autograd.Variable(zeros_)))
+            inputs = torch.cat((inputs, self._zeros(dilated_steps * rate - inputs.size(0), inputs)))
         else:
             dilated_steps = n_steps // rate
 
         return inputs, dilated_steps
 
+    def _zeros(self, n_steps, inputs):
+        # Padding steps, cached by shape since they are never written to
+        key = (n_steps, inputs.size(1), inputs.size(2), inputs.dtype, inputs.device)
+        if not hasattr(self, '_padding'):
+            self._padding = {}
+        if key not in self._padding:
+            self._padding[key] = inputs.new_zeros(key[:3])
+        return self._padding[key]
+
     def _prepare_inputs(self, inputs, rate):
-        dilated_inputs = torch.cat([inputs[j::rate, :, :] for j in range(rate)], 1)
+        if inputs.size(0) % rate != 0:
+            return torch.cat([inputs[j::rate, :, :] for j in range(rate)], 1)
+
+        # (dilated_steps * rate, batch, features) -> (dilated_steps, rate * batch, features), a view
+        # of contiguous inputs, where the j-th block of batch holds the steps j::rate
+        dilated_inputs = inputs.reshape(inputs.size(0) // rate,
+                                        rate * inputs.size(1),
+                                        inputs.size(2))
         return dilated_inputs
 
     def init_hidden(self, batch_size, hidden_dim):
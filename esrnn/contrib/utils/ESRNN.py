@@ -1,6 +1,8 @@
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 from esrnn.contrib.utils.DRNN import DRNN
+from esrnn.contrib.utils.smoothing import es_recursion
 import numpy as np
 
 class _ES(nn.Module):
@@ -30,15 +32,19 @@ class _ES(nn.Module):
     idxs = ts_object.idxs
     n_series, n_time = y.shape
 
-    # Lookup Smoothing parameters per serie
-    init_lvl_sms = [self.lev_sms[idx] for idx in idxs]
-    init_seas_sms = [self.seas_sms[idx] for idx in idxs]
+    # Lookup Smoothing parameters per serie, sparse gradients only touch the batch rows
+    sparse = self.mc.sparse_es
+    init_lvl_sms = F.embedding(idxs, self.lev_sms, sparse=sparse).squeeze(1)
+    init_seas_sms = F.embedding(idxs, self.seas_sms, sparse=sparse).squeeze(1)
 
-    lev_sms = self.logistic(torch.stack(init_lvl_sms).squeeze(1))
-    seas_sms = self.logistic(torch.stack(init_seas_sms).squeeze(1))
+    lev_sms = self.logistic(init_lvl_sms)
+    seas_sms = self.logistic(init_seas_sms)
 
-    init_seas_list = [torch.exp(self.init_seas[idx]) for idx in idxs]
-    init_seas = torch.stack(init_seas_list)
+    init_seas = torch.exp(F.embedding(idxs, self.init_seas, sparse=sparse))
+
+    if self.mc.es_engine == 'fused':
+      levels, seasonalities = es_recursion(y, lev_sms, seas_sms, init_seas)
+      return levels, seasonalities
 
     # Initialize seasonalities and levels
     seasonalities = []
@@ -93,7 +99,7 @@ class _RNN(nn.Module):
       residual = input_data
       output, _ = self.rnn_stack[layer_num](input_data)
       if layer_num > 0:
-        output += residual
+        output = output + residual
       input_data = output
 
     if self.mc.add_nl_layer:
@@ -103,13 +109,40 @@ class _RNN(nn.Module):
     input_data = self.adapterW(input_data)
     return input_data
 
+  def forward_states(self, input_data, states=None):
+    """
+    forward continuing from states, the (h, c) of every dilated layer
+    as in DRNN.forward_states, flat in stack order. Returns the output
+    and the states after the last step.
+    """
+    new_states = []
+    for layer_num in range(len(self.rnn_stack)):
+      layer = self.rnn_stack[layer_num]
+      residual = input_data
+      layer_states = None
+      if states is not None:
+        layer_states = states[len(new_states):len(new_states)+len(layer.cells)]
+      output, layer_states = layer.forward_states(input_data, layer_states)
+      new_states.extend(layer_states)
+      if layer_num > 0:
+        output = output + residual
+      input_data = output
+
+    if self.mc.add_nl_layer:
+      input_data = self.MLPW(input_data)
+      input_data = torch.tanh(input_data)
+
+    input_data = self.adapterW(input_data)
+    return input_data, new_states
+
 
 class _ESRNN(nn.Module):
-  def __init__(self, mc):
+  def __init__(self, mc, rnn=None):
     super(_ESRNN, self).__init__()
     self.mc = mc
     self.es = _ES(mc)
-    self.rnn = _RNN(mc)
+    # A fitted _RNN is shared, not copied
+    self.rnn = _RNN(mc) if rnn is None else rnn
 
   def gaussian_noise(self, input_data, std=0.2):
     size = input_data.size()
@@ -118,7 +151,6 @@ class _ESRNN(nn.Module):
 
   def forward(self, ts_object):
     # parse mc
-    batch_size = self.mc.batch_size
     input_size = self.mc.input_size
     output_size = self.mc.output_size
     exogenous_size = self.mc.exogenous_size
@@ -133,89 +165,139 @@ class _ESRNN(nn.Module):
 
     # Initialize windows, levels and seasonalities
     levels, seasonalities = self.es(ts_object)
-    windows_y_hat = torch.zeros((n_windows, batch_size, input_size+exogenous_size))
-    windows_y = torch.zeros((n_windows, batch_size, output_size))
-    for i in range(n_windows):
-      x_start = i
-      x_end = input_size+i
-
-      # Deseasonalization and normalization
-      window_y_hat = y[:, x_start:x_end] / seasonalities[:, x_start:x_end]
-      window_y_hat = window_y_hat / levels[:, [x_end]]
-      window_y_hat = self.gaussian_noise(torch.log(window_y_hat), std=noise_std)
-
-      # Concatenate categories
-      if exogenous_size>0:
-        window_y_hat = torch.cat((window_y_hat, ts_object.categories), 1)
 
-      y_start = x_end
-      y_end = x_end+output_size
+    # Deseasonalization, windows as strided views of shape (n_series, n_windows, window_size)
+    y_deseas = y / seasonalities[:, :n_time]
+    windows_y_hat = y_deseas.unfold(1, input_size, 1)[:, :n_windows]
+    windows_y = y_deseas[:, input_size:].unfold(1, output_size, 1)
 
-      # Deseasonalization and normalization
-      window_y = y[:, y_start:y_end] / seasonalities[:, y_start:y_end]
-      window_y = window_y / levels[:, [x_end]]
-      window_y = torch.log(window_y)
+    # Normalization by the level at the end of each input window
+    window_levels = levels[:, input_size:input_size+n_windows].unsqueeze(2)
+    windows_y_hat = torch.log(windows_y_hat / window_levels).transpose(0, 1)
+    windows_y_hat = self.gaussian_noise(windows_y_hat, std=noise_std)
+    windows_y = torch.log(windows_y / window_levels).transpose(0, 1)
 
-      windows_y_hat[i, :, :] += window_y_hat
-      windows_y[i, :, :] += window_y
+    # Concatenate categories
+    if exogenous_size>0:
+      categories = ts_object.categories.unsqueeze(0).expand(n_windows, n_series, exogenous_size)
+      windows_y_hat = torch.cat((windows_y_hat, categories), 2)
 
     windows_y_hat = self.rnn(windows_y_hat)
     return windows_y, windows_y_hat, levels
 
-  def predict(self, ts_object):
-    # parse mc
-    batch_size = self.mc.batch_size
+  def es_state(self, ts_object):
+    """
+    End of history state of the exponential smoothing:
+    level: last level, shape (n_series, 1).
+    seasonalities: the seasonality factors following the last observation, shape (n_series, seasonality).
+    windows: deseasonalized last input window, shape (n_series, input_size).
+    rnn_states: with mc.stateful_rnn, the RNN states after the input windows
+                that end before the last observation, see rnn_state.
+    """
     input_size = self.mc.input_size
-    output_size = self.mc.output_size
-    exogenous_size = self.mc.exogenous_size
     seasonality = self.mc.seasonality
 
     # parse ts_object
     y = ts_object.y
-    idxs = ts_object.idxs
     n_series, n_time = y.shape
 
+    levels, seasonalities = self.es(ts_object)
+    state = {'level': levels[:, [n_time-1]],
+             'seasonalities': seasonalities[:, n_time:n_time+seasonality],
+             'windows': y[:, n_time-input_size:] / seasonalities[:, n_time-input_size:n_time]}
+    if self.mc.stateful_rnn:
+      state['rnn_states'] = self.rnn_state(y, levels, seasonalities, ts_object.categories)
+    return state
+
+  def rnn_state(self, y, levels, seasonalities, categories=None):
+    """
+    RNN states after the input windows that end before the last observation,
+    normalized as in training by the level that follows each window.
+    return: (h, c) per dilated layer, with shape (dilation, n_series, state_hsize).
+    """
+    # parse mc
+    input_size = self.mc.input_size
+    exogenous_size = self.mc.exogenous_size
+
+    n_series, n_time = y.shape
+    n_windows = max(n_time-input_size, 0)
+
+    y_deseas = y / seasonalities[:, :n_time]
+    windows_y_hat = y_deseas.unfold(1, input_size, 1)[:, :n_windows]
+    window_levels = levels[:, input_size:input_size+n_windows].unsqueeze(2)
+    windows_y_hat = torch.log(windows_y_hat / window_levels).transpose(0, 1)
+
+    if exogenous_size>0:
+      categories = categories.unsqueeze(0).expand(n_windows, n_series, exogenous_size)
+      windows_y_hat = torch.cat((windows_y_hat, categories), 2)
+
+    _, rnn_states = self.rnn.forward_states(windows_y_hat)
+    return rnn_states
+
+  def rnn_step(self, window, level, categories, rnn_states):
+    """Advances rnn_states by one input window, deseasonalized, normalized by level."""
+    windows_y_hat = torch.log(window / level)
+    if self.mc.exogenous_size>0:
+      windows_y_hat = torch.cat((windows_y_hat, categories), 1)
+    _, rnn_states = self.rnn.forward_states(windows_y_hat.unsqueeze(0), rnn_states)
+    return rnn_states
+
+  def predict_from_state(self, level, seasonalities, window, categories=None, rnn_states=None, rnn=None):
+    # rnn replaces self.rnn for inference, e.g. a quantized copy
+    rnn = self.rnn if rnn is None else rnn
+
+    # parse mc
+    output_size = self.mc.output_size
+    exogenous_size = self.mc.exogenous_size
+    seasonality = self.mc.seasonality
+
     # evaluation mode
     self.eval()
 
     with torch.no_grad():
-      # Initialize windows, levels and seasonalities
-      levels, seasonalities = self.es(ts_object)
-
-      x_start = n_time - input_size
-      x_end = n_time
-
-      # Deseasonalization and normalization
-      windows_y_hat = y[:, x_start:x_end] / seasonalities[:, x_start:x_end]
-      windows_y_hat = windows_y_hat / levels[:, [x_end-1]]
+      # Normalization
+      windows_y_hat = window / level
       windows_y_hat = torch.log(windows_y_hat)
 
       # Concatenate categories 
       if exogenous_size>0:
-        windows_y_hat = torch.cat((windows_y_hat, ts_object.categories), 1)
+        windows_y_hat = torch.cat((windows_y_hat, categories), 1)
 
       windows_y_hat = torch.unsqueeze(windows_y_hat, 0)
 
-      windows_y_hat = self.rnn(windows_y_hat)
+      # A stateful RNN continues from the windows before, without keeping this step
+      if rnn_states is None:
+        windows_y_hat = rnn(windows_y_hat)
+      else:
+        windows_y_hat, _ = rnn.forward_states(windows_y_hat, rnn_states)
       y_hat = torch.squeeze(windows_y_hat, 0)
 
       # Completion of seasonalities if prediction horizon is larger than seasonality
       # Naive2 like prediction, to avoid recursive forecasting
       if output_size > seasonality:
-        repetitions = int(np.ceil(output_size/seasonality))-1
-        last_season = seasonalities[:, -seasonality:]
-        extra_seasonality = last_season.repeat((1, repetitions))
-        seasonalities = torch.cat((seasonalities, extra_seasonality), 1)
+        repetitions = int(np.ceil(output_size/seasonality))
+        seasonalities = seasonalities.repeat((1, repetitions))
+      seasonalities = seasonalities[:, :output_size]
       
       trends = torch.exp(y_hat)
       # Deseasonalization and normalization (inverse)
-      y_hat = trends * levels[:, [n_time-1]]
-      y_hat = y_hat * seasonalities[:, n_time:(n_time+output_size)]
+      y_hat = trends * level
+      y_hat = y_hat * seasonalities
       y_hat = y_hat.data.numpy()
 
       # Decomposition
       trends = trends.data.numpy()
-      seasonalities = seasonalities[:, n_time:(n_time+output_size)].data.numpy()
-      level = levels[:, [n_time-1]].data.numpy()
+      seasonalities = seasonalities.data.numpy()
+      level = level.data.numpy()
 
     return y_hat, trends, seasonalities, level
+
+  def predict(self, ts_object):
+    # evaluation mode
+    self.eval()
+
+    with torch.no_grad():
+      state = self.es_state(ts_object)
+
+    return self.predict_from_state(state['level'], state['seasonalities'], state['windows'],
+                                   ts_object.categories, state.get('rnn_states'))
@@ -4,7 +4,10 @@ class ModelConfig(object):
                lr_scheduler_step_size, noise_std, 
                level_variability_penalty, tau, c_state_penalty,
                state_hsize, dilations, add_nl_layer, seasonality, input_size, output_size, 
-               frequency, max_periods, device, root_dir):
+               frequency, max_periods, device, root_dir, es_engine='python', sparse_es=False,
+               bucket_by_length=False, prefetch_depth=0, budget_lr_schedule=False,
+               val_freq=0, val_metric='smape', patience=3, distributed=False, stateful_rnn=False,
+               quantized_inference=False):
 
     # Train Parameters
     self.max_epochs = max_epochs
@@ -18,12 +21,25 @@ class ModelConfig(object):
     self.level_variability_penalty = level_variability_penalty
     self.c_state_penalty = c_state_penalty
     self.tau = tau
+    self.sparse_es = sparse_es
+    self.bucket_by_length = bucket_by_length
+    self.prefetch_depth = prefetch_depth
+    self.budget_lr_schedule = budget_lr_schedule
+    self.val_freq = val_freq
+    assert val_metric in ['pinball', 'smape'], "val_metric must be 'pinball' or 'smape'"
+    self.val_metric = val_metric
+    self.patience = patience
+    self.distributed = distributed
     self.device = device
 
     # Model Parameters
     self.state_hsize = state_hsize
     self.dilations = dilations
     self.add_nl_layer = add_nl_layer
+    assert es_engine in ['python', 'fused'], "es_engine must be 'python' or 'fused'"
+    self.es_engine = es_engine
+    self.stateful_rnn = stateful_rnn
+    self.quantized_inference = quantized_inference
 
     # Data Parameters
     self.seasonality = seasonality
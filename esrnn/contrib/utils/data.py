@@ -1,116 +1,470 @@
+import json
+import os
+import queue
+import threading
+
 import numpy as np
+import pandas as pd
 import torch
 
 
+def long_to_wide(X_df, y_df):
+  """Long X_df with columns [unique_id, ds, x] and y_df with column y to wide
+  arrays, X with columns [unique_id, x, last_ds] and float32 y with shape
+  (n_series, n_ds), rows sorted by unique_id and columns by ds."""
+  # Categorical codes of series (rows) and date stamps (columns)
+  uid_codes, unique_ids = pd.factorize(X_df['unique_id'], sort=True)
+  ds_codes, sorted_ds = pd.factorize(X_df['ds'], sort=True)
+  n_series, n_ds = len(unique_ids), len(sorted_ds)
+
+  # y values aligned with X_df rows
+  if X_df.index.equals(y_df.index):
+    y_values = y_df['y'].values
+  else:
+    y_values = y_df['y'].reindex(X_df.index).values
+
+  # Flat position of every observation in the wide array, in (unique_id, ds) order
+  flat = uid_codes.astype(np.int64) * n_ds + ds_codes
+  order = np.argsort(flat, kind='stable')
+  if (np.diff(flat[order]) == 0).any():
+    raise ValueError('Index contains duplicate entries, cannot reshape')
+
+  # Scatter values into the wide array in one pass
+  y = np.full((n_series, n_ds), np.nan, dtype=np.float32)
+  y.ravel()[flat] = y_values
+
+  # First x and last ds of each serie, from its first and last row in date order
+  first = np.searchsorted(flat[order], np.arange(n_series, dtype=np.int64) * n_ds)
+  last = np.append(first[1:], len(order)) - 1
+
+  X = np.empty((n_series, 3), dtype=object)
+  X[:, 0] = unique_ids
+  X[:, 1] = X_df['x'].values[order[first]]
+  X[:, 2] = sorted_ds[ds_codes[order[last]]].astype(object)
+
+  # TODO: assert "completeness" of the series (frequency-wise)
+  return X, y
+
+
+def _json_list(values):
+  # NumPy scalars as the Python ones, which JSON can encode
+  return [value.item() if isinstance(value, np.generic) else value for value in values]
+
+
+def _write_index(path, ends, lengths, unique_idxs, categories, last_ds):
+  """Per serie index of an on-disk panel, without pickled objects: offsets and
+  last_ds in index.npz, unique_idxs and categories as JSON lists in ids.json."""
+  np.savez(os.path.join(path, 'index.npz'), ends=np.asarray(ends, dtype=np.int64),
+           lengths=np.asarray(lengths, dtype=np.int64),
+           last_ds=pd.DatetimeIndex(last_ds).values.astype('datetime64[ns]'))
+  with open(os.path.join(path, 'ids.json'), 'w') as f:
+    json.dump({'unique_idxs': _json_list(unique_idxs), 'categories': _json_list(categories)}, f)
+
+
+def _object_array(values):
+  array = np.empty(len(values), dtype=object)
+  array[:] = values
+  return array
+
+
+def _read_index(path):
+  with np.load(os.path.join(path, 'index.npz'), allow_pickle=False) as index:
+    ends, lengths, last_ds = index['ends'], index['lengths'], index['last_ds']
+  with open(os.path.join(path, 'ids.json')) as f:
+    ids = json.load(f)
+  # In memory, as from_wide: object arrays, last_ds of Timestamps
+  return dict(ends=ends, lengths=lengths, unique_idxs=_object_array(ids['unique_idxs']),
+              categories=_object_array(ids['categories']),
+              last_ds=pd.DatetimeIndex(last_ds).astype(object).values)
+
+
 class Batch():
   def __init__(self, mc, y, last_ds, categories, idxs):
     # Parse Model config
     exogenous_size = mc.exogenous_size
     device = mc.device
 
-    # y: time series values
-    n = len(y)
-    y = np.float32(y)        
-    self.idxs = idxs
-    self.y = y
-    if (self.y.shape[1] > mc.max_series_length):
-        self.y = y[:, -mc.max_series_length:]
-    self.y = torch.tensor(y).float()
+    # y: time series values, float32 tensor (n_series, n_time)
+    self.idxs = torch.as_tensor(np.asarray(idxs), dtype=torch.long).to(device)
+    self.y = y.to(device)
 
     # last_ds: last time for prediction purposes
     self.last_ds = last_ds
 
-    # categories: exogenous categoric data
+    # categories: exogenous categoric data, one-hot tensor (n_series, exogenous_size)
+    self.categories = None
     if exogenous_size >0:
-      self.categories = np.zeros((len(idxs), exogenous_size))
-      cols_idx = np.array([mc.category_to_idx[category] for category in categories])
-      rows_idx = np.array(range(len(cols_idx)))
-      self.categories[rows_idx, cols_idx] = 1
-      self.categories = torch.from_numpy(self.categories).float()
+      self.categories = categories.to(device)
+
+
+class Panel(object):
+  """Contiguous float32 store of a panel of series.
+  values: tensor with the observed span of every serie, concatenated.
+  ends: end offset of each serie in values, shape (n_series,).
+  lengths: number of observations of each serie, shape (n_series,).
+  unique_idxs, categories, last_ds: identifier, exogenous category and
+  last date stamp of each serie, shape (n_series,).
+  tail: in memory values after the end of values, for series added by concat
+  to a memory-mapped panel, None without them.
+  """
+  def __init__(self, values, ends, lengths, unique_idxs, categories, last_ds, tail=None):
+    self.values = values
+    self.ends = ends
+    self.lengths = lengths
+    self.unique_idxs = unique_idxs
+    self.categories = categories
+    self.last_ds = last_ds
+    self.tail = tail
+    self.n_series = len(ends)
+
+  @classmethod
+  def from_wide(cls, X, y):
+    """Packs the wide arrays of ESRNN.long_to_wide, X with columns
+    [unique_id, x, last_ds] and y with shape (n_series, n_ds)."""
+    y = np.float32(y)
+    n_series, n_time = y.shape
+    observed = ~np.isnan(y)
+    lengths = np.count_nonzero(observed, axis=1)
+
+    # Observed span of each serie, from its first to its last observation
+    first = np.where(lengths > 0, observed.argmax(1), 0)
+    last = np.where(lengths > 0, n_time - observed[:, ::-1].argmax(1), 0)
+    cols = np.arange(n_time)
+    in_span = (cols >= first[:, None]) & (cols < last[:, None])
+
+    values = torch.from_numpy(np.ascontiguousarray(y[in_span]))
+    ends = np.cumsum(last - first)
+    return cls(values=values, ends=ends, lengths=lengths,
+               unique_idxs=X[:, 0], categories=X[:, 1], last_ds=X[:, 2])
+
+  @classmethod
+  def concat(cls, panels):
+    """Panel with the series of panels, in order. The values of the first
+    panel are shared, never copied nor written to, so a memory-mapped one stays
+    on disk as is. The values of the others go to memory, in the tail."""
+    offsets = np.cumsum([0] + [panel._n_values() for panel in panels[:-1]])
+    tail = [] if panels[0].tail is None else [panels[0].tail]
+    tail += [panel._all_values() for panel in panels[1:]]
+    return cls(values=panels[0].values,
+               ends=np.concatenate([panel.ends + offset for panel, offset in zip(panels, offsets)]),
+               lengths=np.concatenate([panel.lengths for panel in panels]),
+               unique_idxs=np.concatenate([panel.unique_idxs for panel in panels]),
+               categories=np.concatenate([panel.categories for panel in panels]),
+               last_ds=np.concatenate([panel.last_ds for panel in panels]),
+               tail=torch.cat(tail) if len(tail) > 0 else None)
+
+  @classmethod
+  def load(cls, path, mmap=True):
+    """Reads a panel written by save, values are memory-mapped with mmap."""
+    index = _read_index(path)
+    values_path = os.path.join(path, 'values.f32')
+    if mmap:
+      values = np.memmap(values_path, dtype=np.float32, mode='c')
+    else:
+      values = np.fromfile(values_path, dtype=np.float32)
+    return cls(values=torch.from_numpy(values), ends=index['ends'], lengths=index['lengths'],
+               unique_idxs=index['unique_idxs'], categories=index['categories'], last_ds=index['last_ds'])
+
+  def save(self, path):
+    """Writes values and tail as a raw float32 buffer and the per serie index next to it."""
+    if not os.path.exists(path):
+      os.makedirs(path)
+    with open(os.path.join(path, 'values.f32'), 'wb') as values_file:
+      self.values.numpy().tofile(values_file)
+      if self.tail is not None:
+        self.tail.numpy().tofile(values_file)
+    _write_index(path, ends=self.ends, lengths=self.lengths, unique_idxs=self.unique_idxs,
+                 categories=self.categories, last_ds=self.last_ds)
+
+  def take(self, idxs):
+    """Panel with the series in idxs, sharing values."""
+    return Panel(values=self.values, ends=self.ends[idxs], lengths=self.lengths[idxs],
+                 unique_idxs=self.unique_idxs[idxs], categories=self.categories[idxs],
+                 last_ds=self.last_ds[idxs], tail=self.tail)
+
+  def holdout(self, n, freq):
+    """Panel without the last n observations of each serie, sharing values.
+    freq is the frequency of the date stamps, to move last_ds back."""
+    last_ds = pd.DatetimeIndex(self.last_ds) - n * pd.tseries.frequencies.to_offset(freq)
+    return Panel(values=self.values, ends=self.ends - n, lengths=self.lengths - n,
+                 unique_idxs=self.unique_idxs, categories=self.categories,
+                 last_ds=last_ds.astype(object).values, tail=self.tail)
+
+  def _n_values(self):
+    return len(self.values) + (0 if self.tail is None else len(self.tail))
+
+  def _all_values(self):
+    return self.values if self.tail is None else torch.cat([self.values, self.tail])
+
+  def _gather(self, positions):
+    # Positions past the end of values are read from the tail
+    positions = torch.from_numpy(positions)
+    if self.tail is None:
+      return self.values[positions]
+    n_values = len(self.values)
+    in_tail = positions >= n_values
+    return torch.where(in_tail, self.tail[(positions - n_values).clamp(min=0)],
+                       self.values[positions.clamp(max=n_values - 1)])
+
+  def get_last_y(self, idxs, n):
+    """Last n values of the series in idxs."""
+    positions = self.ends[idxs][:, None] - n + np.arange(n)
+    return self._gather(positions)
+
+  def get_trim_y(self, idxs):
+    """Last min_len values of the series in idxs, with min_len their shortest length."""
+    min_len = self.lengths[idxs].min()
+    positions = self.ends[idxs][:, None] - min_len + np.arange(min_len)
+    return self._gather(positions)
+
+
+def write_panel(path, X_df, y_df):
+  """Converts long X_df and y_df, as taken by ESRNN.fit, to an on-disk panel."""
+  Panel.from_wide(*long_to_wide(X_df, y_df)).save(path)
+
+
+def write_panel_csv(path, csv_path, chunksize=1000000):
+  """Streams a long csv with columns [unique_id, ds, x, y] to an on-disk panel,
+  one chunk of rows at a time. Rows of each serie must be contiguous and sorted
+  by ds, missing y are dropped and date gaps are not filled."""
+  if not os.path.exists(path):
+    os.makedirs(path)
+
+  unique_idxs, categories, last_ds, lengths = [], [], [], []
+  with open(os.path.join(path, 'values.f32'), 'wb') as values_file:
+    for chunk in pd.read_csv(csv_path, usecols=['unique_id', 'ds', 'x', 'y'], parse_dates=['ds'],
+                             chunksize=chunksize):
+      chunk = chunk[chunk['y'].notnull()]
+      if len(chunk) == 0:
+        continue
+      chunk_ids = chunk['unique_id'].values
+      chunk_ds = chunk['ds'].values
 
-    self.y.to(device)
-    self.categories.to(device)
+      # Runs of contiguous rows of the same serie
+      starts = np.flatnonzero(np.append(True, chunk_ids[1:] != chunk_ids[:-1]))
+      ends = np.append(starts[1:], len(chunk))
+      same_serie = chunk_ids[1:] == chunk_ids[:-1]
+      assert (chunk_ds[1:][same_serie] > chunk_ds[:-1][same_serie]).all(), "ds not sorted within series"
+
+      # A serie split across chunks continues the last one
+      if len(unique_idxs) > 0 and chunk_ids[0] == unique_idxs[-1]:
+        assert chunk_ds[0] > last_ds[-1], "ds not sorted within series"
+        lengths[-1] += ends[0]
+        last_ds[-1] = chunk_ds[ends[0]-1]
+        starts, ends = starts[1:], ends[1:]
+
+      unique_idxs.extend(chunk_ids[starts])
+      categories.extend(chunk['x'].values[starts])
+      last_ds.extend(chunk_ds[ends-1])
+      lengths.extend(ends - starts)
+      np.float32(chunk['y'].values).tofile(values_file)
+
+  assert pd.Index(unique_idxs).is_unique, "rows of each serie must be contiguous"
+  lengths = np.array(lengths, dtype=np.int64)
+  _write_index(path, ends=np.cumsum(lengths), lengths=lengths, unique_idxs=unique_idxs,
+               categories=categories, last_ds=last_ds)
 
 
 class Iterator(object):
-  def __init__(self, mc, X, y):
-    self.X, self.y = X, y
-    assert len(X)==len(y)
-    
+  def __init__(self, mc, X=None, y=None, panel=None):
+    if panel is None:
+      assert len(X)==len(y)
+      panel = Panel.from_wide(X, y)
+    self.panel = panel
+
     # Parse Model config
     self.mc = mc
     self.batch_size = mc.batch_size
 
-    self.unique_idxs = np.unique(self.X[:, 0])
-    assert len(self.unique_idxs)==len(self.X)
-    self.n_series = len(self.unique_idxs)
-    
+    self.unique_idxs = self.panel.unique_idxs
+    self.n_series = self.panel.n_series
+
+    # Persistent unique_id -> idx hash index, idx is the position in the panel
+    self.unique_id_index = pd.Index(self.unique_idxs)
+    assert self.unique_id_index.is_unique
+
+    # Number of observations and last date stamp of each serie, in idx order
+    self.len_series = self.panel.lengths
+    self.last_ds = self.panel.last_ds
+
+    # Exogenous categories, one-hot rows are gathered per batch
+    if mc.exogenous_size > 0:
+      self.category_idxs = pd.Series(self.panel.categories).map(mc.category_to_idx).values
+      self.one_hot = torch.eye(mc.exogenous_size)
+
     # Initialize batch iterator
+    # sort_key: idx of the serie in each position of the epoch
     self.b = 0
-    self.n_batches = int(self.n_series / self.batch_size)
-    shuffle = list(range(self.n_series))
-    self.sort_key = {'unique_id': [self.unique_idxs[i] for i in shuffle],
-                     'sort_key': shuffle}
+    self.sort_key = np.arange(self.n_series)
+    if mc.bucket_by_length:
+      self.n_batches = int(np.ceil(self.n_series / self.batch_size))
+      self._bucket_by_length()
+    else:
+      self.n_batches = int(self.n_series / self.batch_size)
+      self.batch_bounds = np.minimum(np.arange(self.n_batches+1) * self.batch_size, self.n_series)
+
+  def _bucket_by_length(self, random_seed=None):
+    """Batches of series with similar length, including the remainder batch.
+    With a random_seed ties are broken and batches are visited in random order."""
+    if random_seed is None:
+      order = np.argsort(self.len_series, kind='stable')
+    else:
+      rng = np.random.RandomState(random_seed)
+      shuffle = rng.permutation(self.n_series)
+      order = shuffle[np.argsort(self.len_series[shuffle], kind='stable')]
+
+    batches = [order[first:first+self.batch_size] for first in range(0, self.n_series, self.batch_size)]
+    if random_seed is not None:
+      batches = [batches[i] for i in rng.permutation(len(batches))]
+
+    self.batch_bounds = np.cumsum([0] + [len(batch) for batch in batches])
+    self.sort_key = np.concatenate(batches)
 
   def shuffle_dataset(self, random_seed=1):
     """Return the examples in the dataset in order, or shuffled."""
-    # Random Seed
-    np.random.seed(random_seed)
     self.random_seed = random_seed
-    shuffle = np.random.choice(self.n_series, self.n_series, replace=False)
-    self.X = self.X[shuffle]
-    self.y = self.y[shuffle]
+    if self.mc.bucket_by_length:
+      self._bucket_by_length(random_seed=random_seed)
+      return
 
-    old_sort_key = self.sort_key['sort_key']
-    old_unique_idxs = self.sort_key['unique_id']
-    self.sort_key = {'unique_id': [old_unique_idxs[i] for i in shuffle],
-                'sort_key': [old_sort_key[i] for i in shuffle]}
+    # Random Seed, local state so that shuffling in a prefetch thread stays deterministic
+    rng = np.random.RandomState(random_seed)
+    shuffle = rng.choice(self.n_series, self.n_series, replace=False)
+    self.sort_key = self.sort_key[shuffle]
 
-  def get_trim_batch(self, unique_id):
-    if unique_id==None:
-      # Compute the indexes of the minibatch.
-      first = (self.b * self.batch_size)
-      last = min((first + self.batch_size), self.n_series)
-    else:
-      # Obtain unique_id index
-      assert unique_id in self.sort_key['unique_id'], "unique_id, not fitted"
-      first = self.sort_key['unique_id'].index(unique_id)
-      last = first+1
-
-    # Extract values for batch
-    unique_idxs = self.sort_key['unique_id'][first:last]
-    batch_idxs = self.sort_key['sort_key'][first:last]
-
-    batch_y = self.y[first:last]
-    batch_categories = self.X[first:last, 1]
-    batch_last_ds = self.X[first:last, 2]
-
-    len_series = np.count_nonzero(~np.isnan(batch_y), axis=1)
-    min_len = min(len_series)
-    last_numeric = (~np.isnan(batch_y)).cumsum(1).argmax(1)+1
-
-    # Trimming to match min_len
-    y_b = np.zeros((batch_y.shape[0], min_len))
-    for i in range(batch_y.shape[0]):
-      y_b[i] = batch_y[i,(last_numeric[i]-min_len):last_numeric[i]]
-    batch_y = y_b
-
-    assert not np.isnan(batch_y).any(), \
-           "clean np.nan's from unique_idxs: {}".format(unique_idxs)
-    assert batch_y.shape[0]==len(batch_idxs)==len(batch_last_ds)==len(batch_categories)
+  def waste_stats(self):
+    """Observations and training windows lost by trimming every batch of the
+    current epoch to its shortest serie, and series left out of any batch.
+    Series left out count as trimmed entirely."""
+    bounds = self.batch_bounds
+    lengths = self.len_series[self.sort_key[:bounds[-1]]]
+    batch_sizes = np.diff(bounds)
+    min_lens = np.minimum.reduceat(lengths, bounds[:-1])
+
+    window_size = self.mc.input_size + self.mc.output_size - 1
+    windows = np.maximum(self.len_series - window_size, 0).sum()
+    used_windows = (np.maximum(min_lens - window_size, 0) * batch_sizes).sum()
+    observations = self.len_series.sum()
+    used_observations = (min_lens * batch_sizes).sum()
+
+    stats = {'n_batches': len(batch_sizes),
+             'dropped_series': int(self.n_series - bounds[-1]),
+             'observations': int(observations),
+             'trimmed_observations': int(observations - used_observations),
+             'trimmed_fraction': float(1 - used_observations / observations),
+             'windows': int(windows),
+             'trimmed_windows': int(windows - used_windows)}
+    return stats
+
+  def get_idxs(self, unique_id):
+    """Series idxs for a unique_id or a list of unique_ids."""
+    unique_ids = np.atleast_1d(np.asarray(unique_id, dtype=object))
+    idxs = self.unique_id_index.get_indexer(unique_ids)
+    assert (idxs >= 0).all(), "unique_id, not fitted"
+    return idxs
+
+  def get_lengths(self, idxs):
+    """Number of observations of the series in idxs."""
+    return self.len_series[idxs]
+
+  def get_categories(self, idxs):
+    """One-hot exogenous categories of the series in idxs."""
+    if self.mc.exogenous_size > 0:
+      return self.one_hot[self.category_idxs[idxs]]
+    return None
+
+  def length_batches(self, idxs, batch_size):
+    """Positions of idxs grouped into batches of at most batch_size series with
+    the same length, which are not trimmed by get_idxs_batch."""
+    len_series = self.len_series[idxs]
+    order = np.argsort(len_series, kind='stable')
+    splits = np.flatnonzero(np.diff(len_series[order])) + 1
+    return [group[i:i+batch_size] for group in np.split(order, splits)
+                                  for i in range(0, len(group), batch_size)]
+
+  def get_idxs_batch(self, batch_idxs):
+    """Batch of the series in batch_idxs, without moving the batch iterator."""
+    # Extract values for batch, trimmed to the shortest serie in a single gather
+    batch_y = self.panel.get_trim_y(batch_idxs)
+    batch_last_ds = self.last_ds[batch_idxs]
+    batch_categories = self.get_categories(batch_idxs)
+
+    assert not torch.isnan(batch_y).any(), \
+           "clean np.nan's from unique_idxs: {}".format(self.unique_idxs[batch_idxs])
+    assert batch_y.shape[0]==len(batch_idxs)==len(batch_last_ds)
     assert batch_y.shape[1]>=1
 
     # Feed to Batch
     batch = Batch(mc=self.mc, y=batch_y, last_ds=batch_last_ds,
                   categories=batch_categories, idxs=batch_idxs)
+    return batch
+
+  def get_trim_batch(self, unique_id):
+    if unique_id is None:
+      # Compute the indexes of the minibatch.
+      first = self.batch_bounds[self.b]
+      last = self.batch_bounds[self.b+1]
+      batch_idxs = self.sort_key[first:last]
+    else:
+      # Obtain unique_id indexes
+      batch_idxs = self.get_idxs(unique_id)
+
+    batch = self.get_idxs_batch(batch_idxs)
     self.b = (self.b + 1) % self.n_batches
     return batch
-    
+
   def get_batch(self, unique_id=None):
     return self.get_trim_batch(unique_id)
 
   def __len__(self):
     return self.n_batches
-    
+
   def __iter__(self):
     pass
+
+
+class Prefetcher(object):
+  """Prepares the batches of ESRNN.train in a background thread.
+  Epochs are produced in the same order as the synchronous loop, shuffling
+  with random_seed=epoch, so training is deterministic for a given seed.
+  dataloader: Iterator, owned by the prefetch thread until close.
+  n_epochs: number of epochs to prepare.
+  shuffle: whether to shuffle the dataset at the start of each epoch.
+  depth: maximum number of batches ready ahead of the training step.
+  """
+  def __init__(self, dataloader, n_epochs, shuffle, depth):
+    self.dataloader = dataloader
+    self.queue = queue.Queue(maxsize=depth)
+    self._stop = threading.Event()
+    self._thread = threading.Thread(target=self._produce, args=(n_epochs, shuffle), daemon=True)
+    self._thread.start()
+
+  def _produce(self, n_epochs, shuffle):
+    try:
+      for epoch in range(n_epochs):
+        if shuffle:
+          self.dataloader.shuffle_dataset(random_seed=epoch)
+        for j in range(self.dataloader.n_batches):
+          if not self._put(self.dataloader.get_batch()):
+            return
+    except Exception as e:
+      self._put(e)
+
+  def _put(self, item):
+    while not self._stop.is_set():
+      try:
+        self.queue.put(item, timeout=0.1)
+        return True
+      except queue.Full:
+        pass
+    return False
+
+  def get_batch(self):
+    item = self.queue.get()
+    if isinstance(item, Exception):
+      raise item
+    return item
+
+  def close(self):
+    self._stop.set()
+    self._thread.join()
@@ -0,0 +1,77 @@
+import os
+
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+
+
+def init_process_group(rank, world_size, master_addr='127.0.0.1', master_port=29500):
+  """Joins the gloo process group of a data-parallel ESRNN fit.
+  On several hosts, master_addr is the address of the rank 0 host."""
+  os.environ['MASTER_ADDR'] = master_addr
+  os.environ['MASTER_PORT'] = str(master_port)
+  dist.init_process_group(backend='gloo', rank=rank, world_size=world_size)
+
+
+def _run(rank, fn, world_size, master_port, args):
+  # Cores of the box are split between the local workers
+  torch.set_num_threads(max(1, os.cpu_count() // world_size))
+  init_process_group(rank, world_size, master_port=master_port)
+  try:
+    fn(rank, world_size, *args)
+  finally:
+    dist.destroy_process_group()
+
+
+def spawn(fn, world_size, args=(), master_port=29500):
+  """Runs fn(rank, world_size, *args) in world_size local processes
+  joined in a gloo process group, e.g. to fit an ESRNN with distributed=True."""
+  mp.spawn(_run, args=(fn, world_size, master_port, args), nprocs=world_size, join=True)
+
+
+def get_world():
+  """(rank, world_size) of this process, (0, 1) outside a process group."""
+  if dist.is_available() and dist.is_initialized():
+    return dist.get_rank(), dist.get_world_size()
+  return 0, 1
+
+
+def all_reduce_gradients(params, world_size):
+  """Averages the gradients of params across processes, in a single flat all_reduce."""
+  grads = [param.grad for param in params if param.grad is not None]
+  if len(grads) == 0:
+    return
+  flat = torch.cat([grad.reshape(-1) for grad in grads])
+  dist.all_reduce(flat)
+  flat /= world_size
+  offset = 0
+  for grad in grads:
+    grad.copy_(flat[offset:offset+grad.numel()].view_as(grad))
+    offset += grad.numel()
+
+
+def all_reduce_mean(value, weight=1.0):
+  """Mean of value across processes, weighted by weight."""
+  buffer = torch.tensor([value * weight, weight], dtype=torch.float64)
+  dist.all_reduce(buffer)
+  return (buffer[0] / buffer[1]).item()
+
+
+def all_reduce_max(values):
+  """Elementwise max of the list values across processes."""
+  buffer = torch.tensor(values, dtype=torch.float64)
+  dist.all_reduce(buffer, op=dist.ReduceOp.MAX)
+  return buffer.tolist()
+
+
+def broadcast_parameters(params, src=0):
+  """Copies params of process src to every process."""
+  for param in params:
+    dist.broadcast(param.data, src)
+
+
+def all_gather_object(obj):
+  """List with obj of every process, in rank order."""
+  objs = [None] * dist.get_world_size()
+  dist.all_gather_object(objs, obj)
+  return objs
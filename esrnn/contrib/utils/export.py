@@ -0,0 +1,167 @@
+import copy
+import json
+from typing import List
+
+import numpy as np
+import pandas as pd
+import torch
+import torch.nn as nn
+
+from esrnn.contrib.utils.data import _json_list
+
+
+class _ESRNNInference(nn.Module):
+  """
+  Forecasts of stored series from the end of their history, as _ESRNN.predict_from_state,
+  with the ES state tables of every serie as buffers. Scriptable, the input window
+  is a sequence of length one so each dilated layer is a single LSTM step.
+  esrnn: fitted _ESRNN.
+  state: end of history state of every serie, as ESRNN.es_cache.
+  categories: one-hot categories of every serie, None without exogenous variables.
+  """
+  def __init__(self, esrnn, state, categories=None):
+    super(_ESRNNInference, self).__init__()
+    mc = esrnn.mc
+    n_series = len(state['level'])
+    output_size = mc.output_size
+    repetitions = int(np.ceil(output_size/mc.seasonality))
+
+    self.register_buffer('level', state['level'].clone())
+    self.register_buffer('windows', state['windows'].clone())
+    self.register_buffer('seasonalities', state['seasonalities'].repeat((1, repetitions))[:, :output_size].clone())
+    if categories is None:
+      categories = torch.zeros((n_series, 0))
+    self.register_buffer('categories', categories.clone())
+
+    # Used cells of the DRNN stack, a residual sum closes every group but the first
+    cells = []
+    self.group_starts: List[bool] = []
+    self.group_residuals: List[bool] = []
+    for group, layer in enumerate(esrnn.rnn.rnn_stack):
+      layer_cells = list(layer.cells)
+      for k, cell in enumerate(layer_cells):
+        cells.append(copy.deepcopy(cell))
+        self.group_starts.append(k == 0)
+        self.group_residuals.append(group > 0 and k == len(layer_cells) - 1)
+    self.cells = nn.ModuleList(cells)
+    self.state_hsize: int = mc.state_hsize
+
+    # Stateful RNN, the state of the chain that the next step continues
+    self.stateful: bool = 'rnn_states' in state
+    if self.stateful:
+      self.register_buffer('h', torch.stack([h[0] for h, c in state['rnn_states']]))
+      self.register_buffer('c', torch.stack([c[0] for h, c in state['rnn_states']]))
+    else:
+      self.register_buffer('h', torch.zeros((0, 0, 0)))
+      self.register_buffer('c', torch.zeros((0, 0, 0)))
+
+    self.add_nl_layer: bool = mc.add_nl_layer
+    self.MLPW = copy.deepcopy(esrnn.rnn.MLPW) if mc.add_nl_layer else nn.Identity()
+    self.adapterW = copy.deepcopy(esrnn.rnn.adapterW)
+
+  def forward(self, idxs: torch.Tensor) -> torch.Tensor:
+    level = self.level[idxs]
+
+    # Normalization
+    input_data = torch.log(self.windows[idxs] / level)
+    if self.categories.size(1) > 0:
+      input_data = torch.cat((input_data, self.categories[idxs]), 1)
+    input_data = input_data.unsqueeze(0)
+
+    residual = input_data
+    for i, cell in enumerate(self.cells):
+      if self.group_starts[i]:
+        residual = input_data
+      if self.stateful:
+        h = self.h[i, idxs].unsqueeze(0)
+        c = self.c[i, idxs].unsqueeze(0)
+      else:
+        h = torch.zeros((1, idxs.size(0), self.state_hsize), dtype=input_data.dtype)
+        c = h
+      input_data, _ = cell(input_data, (h, c))
+      if self.group_residuals[i]:
+        input_data = input_data + residual
+
+    if self.add_nl_layer:
+      input_data = torch.tanh(self.MLPW(input_data))
+    trends = torch.exp(self.adapterW(input_data).squeeze(0))
+
+    # Deseasonalization and normalization (inverse)
+    y_hat = trends * level
+    y_hat = y_hat * self.seasonalities[idxs]
+    return y_hat
+
+
+def save_scripted(path, esrnn, state, categories, unique_ids, frequency):
+  """Scripts _ESRNNInference and writes it with the unique_id of every serie
+  and the data to date its forecasts as extra files."""
+  module = torch.jit.script(_ESRNNInference(esrnn, state, categories).eval().requires_grad_(False))
+  meta = {'frequency': frequency,
+          'output_size': esrnn.mc.output_size,
+          'last_ds': [pd.Timestamp(ds).isoformat() for ds in state['last_ds']]}
+  extra_files = {'unique_ids.json': json.dumps(_json_list(unique_ids)),
+                 'meta.json': json.dumps(meta)}
+  torch.jit.save(module, path, _extra_files=extra_files)
+
+
+def load_scripted(path):
+  """
+  Loads a model written by ESRNN.export_torchscript, without the training code.
+  Returns the TorchScript module, which maps a LongTensor of series idxs to
+  forecasts with shape (n_series, output_size), the unique_id of every idx
+  and the metadata (frequency, output_size and last_ds of every serie).
+  """
+  extra_files = {'unique_ids.json': '', 'meta.json': ''}
+  module = torch.jit.load(path, _extra_files=extra_files)
+  unique_ids = json.loads(extra_files['unique_ids.json'])
+  meta = json.loads(extra_files['meta.json'])
+  return module, unique_ids, meta
+
+
+def save_bundle(path, esrnn, state, categories, unique_ids, frequency):
+  """
+  Writes the weights and the end of history ES state of every serie as a
+  NumPy .npz bundle, to be served by esrnn.contrib.utils.runtime without torch.
+  """
+  mc = esrnn.mc
+  n_series = len(state['level'])
+  if categories is None:
+    categories = torch.zeros((n_series, 0))
+  bundle = {'level': state['level'][:, 0],
+            'seasonalities': state['seasonalities'],
+            'windows': state['windows'],
+            'categories': categories,
+            'lev_sms': esrnn.es.logistic(esrnn.es.lev_sms[:, 0]),
+            'seas_sms': esrnn.es.logistic(esrnn.es.seas_sms[:, 0]),
+            'adapterW_weight': esrnn.rnn.adapterW.weight,
+            'adapterW_bias': esrnn.rnn.adapterW.bias}
+  if mc.add_nl_layer:
+    bundle['MLPW_weight'] = esrnn.rnn.MLPW.weight
+    bundle['MLPW_bias'] = esrnn.rnn.MLPW.bias
+
+  # Used cells of the DRNN stack in order, with their group and dilation
+  cell_groups, cell_dilations = [], []
+  for group, layer in enumerate(esrnn.rnn.rnn_stack):
+    for cell, dilation in zip(layer.cells, layer.dilations):
+      i = len(cell_groups)
+      bundle['cell{}_weight_ih'.format(i)] = cell.weight_ih_l0
+      bundle['cell{}_weight_hh'.format(i)] = cell.weight_hh_l0
+      bundle['cell{}_bias'.format(i)] = cell.bias_ih_l0 + cell.bias_hh_l0
+      cell_groups.append(group)
+      cell_dilations.append(dilation)
+  for i, (h, c) in enumerate(state.get('rnn_states', [])):
+    bundle['cell{}_h'.format(i)] = h
+    bundle['cell{}_c'.format(i)] = c
+
+  bundle = dict((key, value.detach().cpu().numpy().astype(np.float32)) for key, value in bundle.items())
+  meta = {'frequency': frequency,
+          'output_size': mc.output_size,
+          'add_nl_layer': mc.add_nl_layer,
+          'stateful': 'rnn_states' in state,
+          'cell_groups': cell_groups,
+          'cell_dilations': cell_dilations,
+          'unique_ids': _json_list(unique_ids)}
+  bundle['last_ds'] = pd.to_datetime(state['last_ds']).values.astype('datetime64[ns]')
+  bundle['meta'] = np.asarray(json.dumps(meta))
+  with open(path, 'wb') as f:
+    np.savez(f, **bundle)
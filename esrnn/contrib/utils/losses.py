@@ -20,6 +20,20 @@ class PinballLoss(nn.Module):
     pinball = pinball.mean()
     return pinball
 
+class SMAPELoss(nn.Module):
+  """Computes the symmetric mean absolute percentage error between y and y_hat.
+  y: actual values in torch tensor.
+  y_hat: predicted values in torch tensor.
+  return: smape
+  """
+  def __init__(self):
+    super(SMAPELoss, self).__init__()
+
+  def forward(self, y, y_hat):
+    smape = 2 * torch.abs(y - y_hat) / (torch.abs(y) + torch.abs(y_hat))
+    smape = smape.mean()
+    return smape
+
 class LevelVariabilityLoss(nn.Module):
   """Computes the variability penalty for the level.
   levels: levels obtained from exponential smoothing component of ESRNN.
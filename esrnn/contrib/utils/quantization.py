@@ -0,0 +1,31 @@
+import copy
+import io
+
+import torch
+import torch.nn as nn
+
+# torch.ao.quantization exists from torch 1.10, torch.quantization before.
+# Both are deprecated in recent torch in favour of torchao, and quantize_dynamic
+# warns on every call there, so quantized_inference may stop working once
+# they are removed.
+try:
+  from torch.ao.quantization import quantize_dynamic
+except ImportError:
+  from torch.quantization import quantize_dynamic
+
+
+def quantize_rnn(rnn, dtype=torch.qint8):
+  """
+  Inference copy of a fitted _RNN with dynamic quantization of its LSTM
+  cells and Linear layers: weights are stored as int8 and activations are
+  quantized on the fly, CPU only. The float _RNN is left untouched.
+  """
+  rnn = copy.deepcopy(rnn).cpu().eval()
+  return quantize_dynamic(rnn, {nn.LSTM, nn.Linear}, dtype=dtype)
+
+
+def state_dict_size(module):
+  """Bytes of the serialized state_dict of module."""
+  buffer = io.BytesIO()
+  torch.save(module.state_dict(), buffer)
+  return buffer.getbuffer().nbytes
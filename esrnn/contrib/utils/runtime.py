@@ -0,0 +1,151 @@
+"""
+NumPy inference runtime for bundles written by ESRNN.export_numpy.
+Imports neither torch nor pandas, for fast starting forecast workers.
+"""
+import json
+
+import numpy as np
+
+
+def _sigmoid(x):
+  return 1 / (1 + np.exp(-x))
+
+
+class NumpyESRNN(object):
+  """
+  Forecasts of the series of an exported ESRNN from their end of history
+  state, as _ESRNN.predict_from_state, and the ES recursion over new
+  observations, as ESRNN.update.
+  path: .npz bundle written by ESRNN.export_numpy.
+  """
+  def __init__(self, path):
+    with np.load(path, allow_pickle=False) as bundle:
+      self.bundle = dict((key, bundle[key]) for key in bundle.files)
+    meta = json.loads(str(self.bundle.pop('meta')))
+    self.frequency = meta['frequency']
+    self.output_size = meta['output_size']
+    self.add_nl_layer = meta['add_nl_layer']
+    self.stateful = meta['stateful']
+    self.cell_groups = meta['cell_groups']
+    self.cell_dilations = meta['cell_dilations']
+
+    # unique_ids go through JSON, which keeps them as fitted, e.g. int or str
+    self.unique_ids = np.empty(len(meta['unique_ids']), dtype=object)
+    self.unique_ids[:] = meta['unique_ids']
+    self.last_ds = self.bundle.pop('last_ds')
+    self.idxs = dict((unique_id, idx) for idx, unique_id in enumerate(self.unique_ids))
+    self.level = self.bundle.pop('level')
+    self.seasonalities = self.bundle.pop('seasonalities')
+    self.windows = self.bundle.pop('windows')
+    self.categories = self.bundle.pop('categories')
+    self.rnn_states = [(self.bundle.pop('cell{}_h'.format(i)), self.bundle.pop('cell{}_c'.format(i)))
+                       for i in range(len(self.cell_groups))] if self.stateful else None
+
+  def get_idxs(self, unique_ids):
+    return np.asarray([self.idxs[unique_id] for unique_id in unique_ids], dtype=np.int64)
+
+  def _lstm_cell(self, i, x, h, c):
+    # Gates in the torch order: input, forget, cell, output
+    gates = x @ self.bundle['cell{}_weight_ih'.format(i)].T + self.bundle['cell{}_bias'.format(i)]
+    if h is not None:
+      gates += h @ self.bundle['cell{}_weight_hh'.format(i)].T
+    in_gate, forget_gate, cell_gate, out_gate = np.split(gates, 4, axis=1)
+    c_new = _sigmoid(in_gate) * np.tanh(cell_gate)
+    if c is not None:
+      c_new += _sigmoid(forget_gate) * c
+    h_new = _sigmoid(out_gate) * np.tanh(c_new)
+    return h_new, c_new
+
+  def _rnn_step(self, window, level, categories, rnn_states=None):
+    """One step of the dilated LSTM stack over the window normalized by level.
+    Returns the output and the states after it, when rnn_states is given."""
+    input_data = np.log(window / level)
+    if categories.shape[1] > 0:
+      input_data = np.concatenate((input_data, categories), 1)
+
+    # Each dilated layer continues the chain in slot 0 of its ring ordered states,
+    # whose new state goes last, a residual sum closes every group but the first
+    new_states = []
+    residual = input_data
+    for i, group in enumerate(self.cell_groups):
+      if i == 0 or group != self.cell_groups[i-1]:
+        residual = input_data
+      h, c = (None, None) if rnn_states is None else (rnn_states[i][0][0], rnn_states[i][1][0])
+      input_data, c_new = self._lstm_cell(i, input_data, h, c)
+      if rnn_states is not None:
+        new_states.append((np.concatenate((rnn_states[i][0][1:], input_data[None])),
+                           np.concatenate((rnn_states[i][1][1:], c_new[None]))))
+      if group > 0 and (i == len(self.cell_groups) - 1 or self.cell_groups[i+1] != group):
+        input_data = input_data + residual
+
+    if self.add_nl_layer:
+      input_data = np.tanh(input_data @ self.bundle['MLPW_weight'].T + self.bundle['MLPW_bias'])
+    output = input_data @ self.bundle['adapterW_weight'].T + self.bundle['adapterW_bias']
+    return output, new_states
+
+  def predict(self, unique_ids=None):
+    """
+    Forecasts with shape (n_series, output_size) of unique_ids, default every
+    serie of the bundle, in the order of unique_ids.
+    """
+    idxs = np.arange(len(self.unique_ids)) if unique_ids is None else self.get_idxs(unique_ids)
+    level = self.level[idxs, None]
+    rnn_states = None
+    if self.stateful:
+      rnn_states = [(h[:, idxs], c[:, idxs]) for h, c in self.rnn_states]
+    output, _ = self._rnn_step(self.windows[idxs], level, self.categories[idxs], rnn_states)
+    trends = np.exp(output)
+
+    # Completion of seasonalities if prediction horizon is larger than seasonality
+    seasonalities = self.seasonalities[idxs]
+    repetitions = int(np.ceil(self.output_size/seasonalities.shape[1]))
+    seasonalities = np.tile(seasonalities, (1, repetitions))[:, :self.output_size]
+
+    # Deseasonalization and normalization (inverse)
+    return trends * level * seasonalities
+
+  def update(self, unique_ids, y, last_ds):
+    """
+    Advances the ES state (and the RNN states of a stateful model) of
+    unique_ids over new observations y with shape (n_series, n_time),
+    NaN where a serie has no observation, as ESRNN.update.
+    last_ds: last date of y of each serie.
+    """
+    idxs = self.get_idxs(unique_ids)
+    y = np.asarray(y, dtype=np.float32)
+    lev_sms = self.bundle['lev_sms'][idxs]
+    seas_sms = self.bundle['seas_sms'][idxs]
+    level = self.level[idxs]
+    seasonalities = self.seasonalities[idxs]
+    windows = self.windows[idxs]
+    categories = self.categories[idxs]
+    rnn_states = None
+    if self.stateful:
+      rnn_states = [(h[:, idxs], c[:, idxs]) for h, c in self.rnn_states]
+
+    for t in range(y.shape[1]):
+      observed = ~np.isnan(y[:, t])
+      y_t = np.where(observed, y[:, t], level * seasonalities[:, 0])
+      deseasonalized = y_t / seasonalities[:, 0]
+      newlev = lev_sms * deseasonalized + (1-lev_sms) * level
+      newseason = seas_sms * (y_t / newlev) + (1-seas_sms) * seasonalities[:, 0]
+
+      if rnn_states is not None:
+        _, new_rnn_states = self._rnn_step(windows, newlev[:, None], categories, rnn_states)
+        rnn_states = [(np.where(observed[None, :, None], new_h, h), np.where(observed[None, :, None], new_c, c))
+                      for (h, c), (new_h, new_c) in zip(rnn_states, new_rnn_states)]
+
+      level = np.where(observed, newlev, level)
+      seasonalities = np.where(observed[:, None],
+                               np.concatenate([seasonalities[:, 1:], newseason[:, None]], 1), seasonalities)
+      windows = np.where(observed[:, None],
+                         np.concatenate([windows[:, 1:], deseasonalized[:, None]], 1), windows)
+
+    self.level[idxs] = level
+    self.seasonalities[idxs] = seasonalities
+    self.windows[idxs] = windows
+    if rnn_states is not None:
+      for (h, c), (new_h, new_c) in zip(self.rnn_states, rnn_states):
+        h[:, idxs] = new_h
+        c[:, idxs] = new_c
+    self.last_ds[idxs] = np.asarray(last_ds, dtype='datetime64[ns]')
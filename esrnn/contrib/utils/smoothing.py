@@ -0,0 +1,104 @@
+import numpy as np
+import torch
+
+
+def _es_forward_kernel(y, lev_sms, seas_sms, init_seas):
+  """Time-major Holt-Winters recursion over numpy arrays.
+  Returns levels with shape (n_time, n_series) and
+  seasonalities with shape (n_time+seasonality, n_series).
+  """
+  n_series, n_time = y.shape
+  seasonality = init_seas.shape[1]
+  y_t = np.ascontiguousarray(y.T)
+  one_lev_sms = 1 - lev_sms
+  one_seas_sms = 1 - seas_sms
+
+  levels = np.empty((n_time, n_series), dtype=y.dtype)
+  seasonalities = np.empty((n_time + seasonality, n_series), dtype=y.dtype)
+  seasonalities[:seasonality] = init_seas.T
+  seasonalities[seasonality] = init_seas[:, 0]
+  levels[0] = y_t[0] / seasonalities[0]
+
+  for t in range(1, n_time):
+    newlev = lev_sms * (y_t[t] / seasonalities[t]) + one_lev_sms * levels[t-1]
+    levels[t] = newlev
+    seasonalities[t+seasonality] = seas_sms * (y_t[t] / newlev) + one_seas_sms * seasonalities[t]
+
+  return levels, seasonalities
+
+
+def _es_backward_kernel(y, lev_sms, seas_sms, levels, seasonalities, grad_levels, grad_seasonalities):
+  """Reverse-mode sweep of _es_forward_kernel, accumulating adjoints from the last time step."""
+  n_time = levels.shape[0]
+  seasonality = seasonalities.shape[0] - n_time
+  y_t = np.ascontiguousarray(y.T)
+  one_lev_sms = 1 - lev_sms
+  one_seas_sms = 1 - seas_sms
+
+  g_lev = np.array(grad_levels.T, dtype=levels.dtype)
+  g_seas = np.array(grad_seasonalities.T, dtype=levels.dtype)
+  g_lev_sms = np.zeros_like(lev_sms)
+  g_seas_sms = np.zeros_like(seas_sms)
+
+  for t in range(n_time-1, 0, -1):
+    # newseason = seas_sms * (y[t] / newlev) + (1-seas_sms) * seasonalities[t]
+    g_newseason = g_seas[t+seasonality]
+    y_over_lev = y_t[t] / levels[t]
+    g_seas_sms += g_newseason * (y_over_lev - seasonalities[t])
+    g_lev[t] -= g_newseason * seas_sms * y_over_lev / levels[t]
+    g_seas[t] += g_newseason * one_seas_sms
+
+    # newlev = lev_sms * (y[t] / seasonalities[t]) + (1-lev_sms) * levels[t-1]
+    g_newlev = g_lev[t]
+    y_over_seas = y_t[t] / seasonalities[t]
+    g_lev_sms += g_newlev * (y_over_seas - levels[t-1])
+    g_seas[t] -= g_newlev * lev_sms * y_over_seas / seasonalities[t]
+    g_lev[t-1] += g_newlev * one_lev_sms
+
+  # levels[0] = y[0] / seasonalities[0] and seasonalities[seasonality] = init_seas[:, 0]
+  g_seas[0] -= g_lev[0] * y_t[0] / (seasonalities[0] * seasonalities[0])
+  g_seas[0] += g_seas[seasonality]
+  g_init_seas = np.ascontiguousarray(g_seas[:seasonality].T)
+
+  return g_lev_sms, g_seas_sms, g_init_seas
+
+
+def _to_numpy(tensor):
+  return tensor.detach().cpu().numpy()
+
+
+class ESRecursion(torch.autograd.Function):
+  """Level and seasonality recursion of _ES as a single autograd node.
+  The forward and backward sweeps run as plain numpy loops, so the graph
+  does not grow with the number of time steps.
+  y: actual values, tensor with shape (n_series, n_time).
+  lev_sms: level smoothing coefficients, tensor with shape (n_series,).
+  seas_sms: seasonality smoothing coefficients, tensor with shape (n_series,).
+  init_seas: initial seasonalities, tensor with shape (n_series, seasonality).
+  return: levels with shape (n_series, n_time) and
+          seasonalities with shape (n_series, n_time+seasonality).
+  """
+  @staticmethod
+  def forward(ctx, y, lev_sms, seas_sms, init_seas):
+    y_np, lev_sms_np, seas_sms_np = _to_numpy(y), _to_numpy(lev_sms), _to_numpy(seas_sms)
+    levels, seasonalities = _es_forward_kernel(y_np, lev_sms_np, seas_sms_np, _to_numpy(init_seas))
+    ctx.device = y.device
+    ctx.kernel_state = (y_np, lev_sms_np, seas_sms_np, levels, seasonalities)
+    levels = torch.from_numpy(levels).to(y.device)
+    seasonalities = torch.from_numpy(seasonalities).to(y.device)
+    return levels.t(), seasonalities.t()
+
+  @staticmethod
+  def backward(ctx, grad_levels, grad_seasonalities):
+    y, lev_sms, seas_sms, levels, seasonalities = ctx.kernel_state
+    grad_levels = _to_numpy(grad_levels) if grad_levels is not None else np.zeros_like(levels.T)
+    grad_seasonalities = _to_numpy(grad_seasonalities) if grad_seasonalities is not None \
+                         else np.zeros_like(seasonalities.T)
+    grads = _es_backward_kernel(y, lev_sms, seas_sms, levels, seasonalities,
+                                grad_levels, grad_seasonalities)
+    g_lev_sms, g_seas_sms, g_init_seas = [torch.from_numpy(g).to(ctx.device) for g in grads]
+    return None, g_lev_sms, g_seas_sms, g_init_seas
+
+
+def es_recursion(y, lev_sms, seas_sms, init_seas):
+  return ESRecursion.apply(y, lev_sms, seas_sms, init_seas)
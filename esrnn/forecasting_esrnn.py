@@ -1,6 +1,7 @@
 import os
 import sys
 
+import numpy as np
 import pandas as pd
 from d3m import container, utils as d3m_utils
 from d3m.exceptions import PrimitiveNotFittedError
@@ -67,6 +68,48 @@ class ForecastingESRNNHyperparams(hyperparams.Hyperparams):
         description="",  # TODO
         semantic_types=["https://metadata.datadrivendiscovery.org/types/ControlParameter", ]
     )
+    warm_start = hyperparams.UniformBool(
+        default=False,
+        description="refits resume from the fitted parameters and optimizer state instead of a new model, "
+                    "unless the data has new categories",
+        semantic_types=["https://metadata.datadrivendiscovery.org/types/ControlParameter", ]
+    )
+    warm_start_epochs = hyperparams.UniformInt(
+        default=5,
+        lower=0,
+        upper=sys.maxsize,
+        description="epochs to do on warm started fit process",
+        semantic_types=["https://metadata.datadrivendiscovery.org/types/ControlParameter", ]
+    )
+    val_freq = hyperparams.UniformInt(
+        default=0,
+        lower=0,
+        upper=sys.maxsize,
+        description="epochs between validation evaluations on a holdout of output_size points, 0 disables validation",
+        semantic_types=["https://metadata.datadrivendiscovery.org/types/ControlParameter", ]
+    )
+    patience = hyperparams.UniformInt(
+        default=3,
+        lower=1,
+        upper=sys.maxsize,
+        description="validation evaluations without improvement before early stopping",
+        semantic_types=["https://metadata.datadrivendiscovery.org/types/ControlParameter", ]
+    )
+    stateful_rnn = hyperparams.UniformBool(
+        default=False,
+        description="forecasts continue the RNN states of each serie history instead of a zero state",
+        semantic_types=["https://metadata.datadrivendiscovery.org/types/ControlParameter", ]
+    )
+    quantized_inference = hyperparams.UniformBool(
+        default=False,
+        description="produce with a dynamic int8 quantized copy of the RNN, faster on CPU at a small accuracy cost",
+        semantic_types=["https://metadata.datadrivendiscovery.org/types/ControlParameter", ]
+    )
+    budget_lr_schedule = hyperparams.UniformBool(
+        default=False,
+        description="decay the learning rate along the fit timeout or iterations budget instead of per epoch",
+        semantic_types=["https://metadata.datadrivendiscovery.org/types/ControlParameter", ]
+    )
 
 
 class ForecastingESRNNPrimitive(SupervisedLearnerPrimitiveBase[Inputs, Outputs, ForecastingESRNNParams,
@@ -110,7 +153,12 @@ class ForecastingESRNNPrimitive(SupervisedLearnerPrimitiveBase[Inputs, Outputs,
             learning_rate=hyperparams['learning_rate'],
             seasonality=hyperparams['seasonality'],
             input_size=hyperparams['input_size'],
-            output_size=hyperparams['output_size']
+            output_size=hyperparams['output_size'],
+            budget_lr_schedule=hyperparams['budget_lr_schedule'],
+            val_freq=hyperparams['val_freq'],
+            patience=hyperparams['patience'],
+            stateful_rnn=hyperparams['stateful_rnn'],
+            quantized_inference=hyperparams['quantized_inference']
         )
         self._data = None
         self._integer_time = False
@@ -223,7 +271,7 @@ class ForecastingESRNNPrimitive(SupervisedLearnerPrimitiveBase[Inputs, Outputs,
             self.filter_idxs.append(year_column)
 
             # concatenate columns in `grouping_keys` to unique_id column
-            concat = data.loc[:, self.filter_idxs].apply(lambda x: '-'.join([str(v) for v in x]), axis=1)
+            concat = ForecastingESRNNPrimitive._build_unique_id(data, self.filter_idxs)
             concat = pd.concat([concat,
                                 data[year_column].astype(str),
                                 data[self._time_column],
@@ -242,10 +290,21 @@ class ForecastingESRNNPrimitive(SupervisedLearnerPrimitiveBase[Inputs, Outputs,
     def fit(self, *, timeout: float = None, iterations: int = None) -> CallResult[None]:
         X_train = self._data[['unique_id', 'ds', 'x']]
         y_train = self._data[['unique_id', 'ds', 'y']]
-        self._esrnn.fit(X_train, y_train, self.random_seed)
+        warm_start = self.hyperparams['warm_start'] and self._is_fitted
+        if warm_start and not set(X_train['x']).issubset(self._esrnn.mc.category_to_idx):
+            # A new category, e.g. a new year, changes the RNN input so it needs a new model
+            warm_start = False
+        if warm_start:
+            self._esrnn.fit(X_train, y_train, self.random_seed, warm_start=True,
+                            max_epochs=self.hyperparams['warm_start_epochs'],
+                            timeout=timeout, iterations=iterations)
+        else:
+            self._esrnn.fit(X_train, y_train, self.random_seed, timeout=timeout, iterations=iterations)
         self._is_fitted = True
 
-        return base.CallResult(None)
+        train_stats = self._esrnn.train_stats
+        return base.CallResult(None, has_finished=train_stats['has_finished'],
+                               iterations_done=train_stats['iterations_done'])
 
     def produce(self, *, inputs: Inputs, timeout: float = None, iterations: int = None) -> CallResult[Outputs]:
         if not self._is_fitted:
@@ -284,7 +343,7 @@ class ForecastingESRNNPrimitive(SupervisedLearnerPrimitiveBase[Inputs, Outputs,
             inputs_copy[self._year_column] = inputs_copy[self._time_column].dt.year
 
             # concatenate columns in `grouping_keys` to unique_id column
-            concat = inputs_copy.loc[:, self.filter_idxs].apply(lambda x: '-'.join([str(v) for v in x]), axis=1)
+            concat = ForecastingESRNNPrimitive._build_unique_id(inputs_copy, self.filter_idxs)
             concat = pd.concat([concat, inputs_copy[self._time_column]], axis=1)
             concat.columns = ['unique_id', 'ds']
 
@@ -302,20 +361,46 @@ class ForecastingESRNNPrimitive(SupervisedLearnerPrimitiveBase[Inputs, Outputs,
         return ForecastingESRNNParams(is_fitted=self._is_fitted)
 
     @staticmethod
-    def _ffill_missing_dates_particular_serie(serie, min_date, max_date, freq):
-        date_range = pd.date_range(start=min_date, end=max_date, freq=freq)
-        unique_id = serie['unique_id'].unique()
-        df_balanced = pd.DataFrame({'ds': date_range, 'key': [1] * len(date_range), 'unique_id': unique_id[0]})
+    def _build_unique_id(data, columns):
+        """Joins the values of columns with '-' into one unique_id per row. Rows get an int64 key
+        combined from the categorical codes of each column, and only the first row of each key
+        is formatted into the lookup table of strings"""
+        keys = data.loc[:, columns]
+        group_codes = np.zeros(len(keys), dtype=np.int64)
+        for column in keys.columns:
+            codes, uniques = pd.factorize(keys[column])
+            group_codes, _ = pd.factorize(group_codes * (len(uniques) + 1) + (codes + 1))
+
+        first_rows = pd.Series(group_codes).drop_duplicates()
+        labels = np.empty(len(first_rows), dtype=object)
+        labels[first_rows.values] = keys.iloc[first_rows.index].apply(lambda x: '-'.join([str(v) for v in x]),
+                                                                      axis=1).values
+        return pd.Series(labels[group_codes], index=data.index)
 
-        # Check balance
-        check_balance = df_balanced.groupby(['unique_id']).size().reset_index(name='count')
-        assert len(set(check_balance['count'].values)) <= 1
-        df_balanced = df_balanced.merge(serie, how="left", on=['unique_id', 'ds'])
-
-        df_balanced['y'] = df_balanced['y'].fillna(method='ffill')
-        df_balanced['x'] = df_balanced['x'].fillna(method='ffill')
+    @staticmethod
+    def _date_ranges(df_max_min_dates, freq):
+        """Balanced (unique_id, ds) pairs, one date range from min_date to max_date per serie"""
+        offset = pd.tseries.frequencies.to_offset(freq)
+        min_dates = pd.DatetimeIndex(df_max_min_dates['min_date'])
+        max_dates = pd.DatetimeIndex(df_max_min_dates['max_date'])
+
+        if isinstance(offset, pd.offsets.Tick):
+            # Fixed step frequencies, ranges built with array arithmetic
+            step = pd.Timedelta(offset).value
+            min_ns = min_dates.values.astype('datetime64[ns]').astype(np.int64)
+            max_ns = max_dates.values.astype('datetime64[ns]').astype(np.int64)
+            periods = (max_ns - min_ns) // step + 1
+            range_starts = np.cumsum(periods) - periods
+            steps = np.arange(periods.sum()) - np.repeat(range_starts, periods)
+            ds = pd.DatetimeIndex(np.repeat(min_ns, periods) + steps * step)
+        else:
+            # Calendar frequencies are anchored by date_range
+            ranges = [pd.date_range(start=min_date, end=max_date, freq=freq)
+                      for min_date, max_date in zip(min_dates, max_dates)]
+            periods = np.array([len(date_range) for date_range in ranges])
+            ds = ranges[0].append(ranges[1:])
 
-        return df_balanced
+        return pd.DataFrame({'unique_id': np.repeat(df_max_min_dates['unique_id'].values, periods), 'ds': ds})
 
     @staticmethod
     def _ffill_missing_dates_per_serie(df, freq="D", fixed_max_date=None):
@@ -344,13 +429,11 @@ class ForecastingESRNNPrimitive(SupervisedLearnerPrimitiveBase[Inputs, Outputs,
         df_max_min_dates.columns = df_max_min_dates.columns.droplevel()
         df_max_min_dates.columns = ['unique_id', 'min_date', 'max_date']
 
-        df_list = []
-        for index, row in df_max_min_dates.iterrows():
-            df_id = df[df['unique_id'] == row['unique_id']]
-            df_id = ForecastingESRNNPrimitive._ffill_missing_dates_particular_serie(df_id, row['min_date'],
-                                                                                    row['max_date'], freq)
-            df_list.append(df_id)
+        # Single merge of all series against their balanced date ranges, then forward fill within each serie
+        df_balanced = ForecastingESRNNPrimitive._date_ranges(df_max_min_dates, freq)
+        df_balanced = df_balanced.merge(df, how="left", on=['unique_id', 'ds'])
+        df_balanced[['y', 'x']] = df_balanced.groupby('unique_id', sort=False)[['y', 'x']].ffill()
 
-        df_dates = pd.concat(df_list).reset_index(drop=True).drop('key', axis=1)[['unique_id', 'ds', 'y', 'x']]
+        df_dates = df_balanced[['unique_id', 'ds', 'y', 'x']]
 
         return df_dates
@@ -0,0 +1,33 @@
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+
+def make_long(n_series=12, min_len=40, max_len=60, seed=0):
+  """Long X_df and y_df of seasonal series with ragged lengths and three categories."""
+  rng = np.random.RandomState(seed)
+  X_dfs, y_dfs = [], []
+  for i in range(n_series):
+    n_time = rng.randint(min_len, max_len)
+    ds = pd.date_range('2000-01-01', periods=n_time, freq='D')
+    y = 10 + 2 * np.sin(np.arange(n_time) * 2 * np.pi / 4) + rng.rand(n_time) + i
+    unique_id = 'id_{:02d}'.format(i)
+    X_dfs.append(pd.DataFrame({'unique_id': unique_id, 'ds': ds, 'x': 'c{}'.format(i % 3)}))
+    y_dfs.append(pd.DataFrame({'unique_id': unique_id, 'ds': ds, 'y': y}))
+  return pd.concat(X_dfs, ignore_index=True), pd.concat(y_dfs, ignore_index=True)
+
+
+@pytest.fixture
+def long_dfs():
+  return make_long()
+
+
+@pytest.fixture
+def model_kwargs():
+  # Small model, fast to fit
+  return dict(max_epochs=2, batch_size=4, seasonality=4, input_size=4, output_size=8, state_hsize=8)
@@ -0,0 +1,53 @@
+import hashlib
+import os
+
+import numpy as np
+import pandas as pd
+
+from esrnn.contrib.ESRNN import ESRNN
+from esrnn.contrib.utils.data import write_panel
+
+
+def _split(long_dfs, n_old=8):
+  X_df, y_df = long_dfs
+  old = X_df['unique_id'].isin(X_df['unique_id'].unique()[:n_old])
+  return (X_df[old], y_df[old]), (X_df[~old], y_df[~old])
+
+
+def _digest(path):
+  with open(path, 'rb') as f:
+    return hashlib.sha1(f.read()).hexdigest()
+
+
+def test_add_series_leaves_fitted_series_and_panel_directory(long_dfs, model_kwargs, tmp_path):
+  (X_old, y_old), (X_new, y_new) = _split(long_dfs)
+  path = str(tmp_path / 'panel')
+  write_panel(path, X_old, y_old)
+  values_path = os.path.join(path, 'values.f32')
+  digests = dict((name, _digest(os.path.join(path, name))) for name in os.listdir(path))
+
+  model = ESRNN(**model_kwargs)
+  model.fit_panel(path)
+  old_ids = X_old[['unique_id']].drop_duplicates()
+  Y_hat_old = model.predict(old_ids)
+
+  model.add_series(X_new, y_new, max_epochs=2)
+  assert dict((name, _digest(os.path.join(path, name))) for name in os.listdir(path)) == digests
+  assert os.path.getsize(values_path) == 4 * len(model.dataloader.panel.values)
+
+  # Fitted series forecast as before, new ones from their own history
+  pd.testing.assert_frame_equal(model.predict(old_ids), Y_hat_old)
+  Y_hat = model.predict(X_new[['unique_id']].drop_duplicates())
+  assert Y_hat['y_hat'].notnull().all()
+  assert set(Y_hat['unique_id']) == set(X_new['unique_id'])
+
+  # Last observations of the new series are read from the tail
+  panel = model.dataloader.panel
+  new_idxs = model.dataloader.get_idxs(X_new['unique_id'].unique())
+  last_y = y_new.groupby('unique_id')['y'].apply(lambda y: y.values[-4:])
+  np.testing.assert_allclose(panel.get_last_y(new_idxs, 4).numpy(),
+                             np.stack(last_y[panel.unique_idxs[new_idxs]].values), rtol=1e-6)
+
+  # A saved extended panel has every serie
+  model.dataloader.panel.save(str(tmp_path / 'extended'))
+  assert os.path.getsize(str(tmp_path / 'extended' / 'values.f32')) == 4 * len(long_dfs[1])
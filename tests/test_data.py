@@ -0,0 +1,64 @@
+import numpy as np
+
+from esrnn.contrib.ESRNN import ESRNN
+from esrnn.contrib.utils.data import Iterator, Panel, long_to_wide, write_panel, write_panel_csv
+
+
+def _iterator(long_dfs, model_kwargs, **kwargs):
+  X_df, y_df = long_dfs
+  # Categories are not needed to batch
+  mc = ESRNN(**dict(model_kwargs, **kwargs)).mc
+  mc.exogenous_size = 0
+  return Iterator(mc=mc, panel=Panel.from_wide(*long_to_wide(X_df, y_df)))
+
+
+def test_waste_stats_count_dropped_series(long_dfs, model_kwargs):
+  # 12 series in batches of 5, the default mode leaves 2 series out
+  dataloader = _iterator(long_dfs, model_kwargs, batch_size=5)
+  stats = dataloader.waste_stats()
+  kept = dataloader.sort_key[:10]
+  dropped = dataloader.sort_key[10:]
+  lengths = dataloader.len_series
+  min_lens = [lengths[kept[:5]].min(), lengths[kept[5:]].min()]
+
+  assert stats['dropped_series'] == 2
+  assert stats['observations'] == lengths.sum()
+  assert stats['trimmed_observations'] == lengths.sum() - 5 * sum(min_lens)
+  assert stats['trimmed_observations'] >= lengths[dropped].sum()
+  np.testing.assert_allclose(stats['trimmed_fraction'], 1 - 5 * sum(min_lens) / lengths.sum())
+
+  # Length buckets keep every serie
+  stats = _iterator(long_dfs, model_kwargs, batch_size=5, bucket_by_length=True).waste_stats()
+  assert stats['dropped_series'] == 0
+  assert stats['observations'] == lengths.sum()
+
+
+def _assert_same_panel(panel, expected):
+  np.testing.assert_array_equal(panel.values.numpy(), expected.values.numpy())
+  np.testing.assert_array_equal(panel.ends, expected.ends)
+  np.testing.assert_array_equal(panel.lengths, expected.lengths)
+  assert list(panel.unique_idxs) == list(expected.unique_idxs)
+  assert list(panel.categories) == list(expected.categories)
+  assert list(panel.last_ds) == list(expected.last_ds)
+
+
+def test_panel_round_trip(long_dfs, tmp_path):
+  X_df, y_df = long_dfs
+  panel = Panel.from_wide(*long_to_wide(X_df, y_df))
+  panel.save(str(tmp_path / 'saved'))
+  for mmap in [True, False]:
+    _assert_same_panel(Panel.load(str(tmp_path / 'saved'), mmap=mmap), panel)
+
+  # Streamed from a csv in small chunks, series split across them
+  df = X_df.merge(y_df, on=['unique_id', 'ds']).sort_values(['unique_id', 'ds'])
+  df.to_csv(str(tmp_path / 'panel.csv'), index=False)
+  write_panel_csv(str(tmp_path / 'streamed'), str(tmp_path / 'panel.csv'), chunksize=7)
+  _assert_same_panel(Panel.load(str(tmp_path / 'streamed')), panel)
+
+  # Int ids keep their type
+  X_df, y_df = X_df.copy(), y_df.copy()
+  X_df['unique_id'] = y_df['unique_id'] = y_df['unique_id'].str[3:].astype(int)
+  write_panel(str(tmp_path / 'int_ids'), X_df, y_df)
+  unique_idxs = Panel.load(str(tmp_path / 'int_ids')).unique_idxs
+  assert list(unique_idxs) == list(range(12))
+  assert all(isinstance(unique_id, int) for unique_id in unique_idxs)
@@ -0,0 +1,47 @@
+import pytest
+import torch
+
+from benchmarks.drnn_dilation import CatDRNN
+from esrnn.contrib.utils.DRNN import DRNN
+
+
+DILATIONS = [[1, 2], [4, 8], [1, 2, 4, 8], [3, 5], [7]]
+
+
+@pytest.mark.parametrize('dilations', DILATIONS)
+@pytest.mark.parametrize('n_steps', [1, 5, 8, 13, 24])
+def test_reshape_dilation_is_bit_identical(dilations, n_steps):
+  torch.manual_seed(0)
+  drnn = DRNN(6, 5, len(dilations), dilations=dilations, cell_type='LSTM')
+  reference = CatDRNN(6, 5, len(dilations), dilations=dilations, cell_type='LSTM')
+  reference.load_state_dict(drnn.state_dict())
+  inputs = torch.randn(n_steps, 3, 6)
+
+  results = []
+  for model in [drnn, reference]:
+    x = inputs.clone().requires_grad_(True)
+    output, layer_outputs = model(x)
+    (output.pow(2).sum() + sum([layer_output.sum() for layer_output in layer_outputs])).backward()
+    results.append([output] + layer_outputs + [x.grad] + [param.grad for param in model.parameters()])
+  for value, reference_value in zip(*results):
+    assert torch.equal(value, reference_value)
+
+
+@pytest.mark.parametrize('dilations', DILATIONS)
+@pytest.mark.parametrize('split', [1, 6, 11])
+def test_forward_states_continues_a_sequence(dilations, split):
+  # Ring ordered states after a prefix continue the sequence as a single pass does
+  torch.manual_seed(0)
+  drnn = DRNN(6, 5, len(dilations), dilations=dilations, cell_type='LSTM')
+  inputs = torch.randn(17, 3, 6)
+  with torch.no_grad():
+    output, _ = drnn(inputs)
+    states_output, states = drnn.forward_states(inputs)
+    head, head_states = drnn.forward_states(inputs[:split])
+    tail, tail_states = drnn.forward_states(inputs[split:], head_states)
+
+  assert torch.allclose(states_output, output, atol=1e-6)
+  assert torch.allclose(torch.cat([head, tail]), output, atol=1e-6)
+  for (h, c), (tail_h, tail_c) in zip(states, tail_states):
+    assert torch.allclose(h, tail_h, atol=1e-6)
+    assert torch.allclose(c, tail_c, atol=1e-6)
@@ -0,0 +1,53 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+pytest.importorskip('d3m')
+from esrnn.forecasting_esrnn import ForecastingESRNNPrimitive
+
+
+def _ffill_reference(df, freq, fixed_max_date=None):
+  # One date_range, merge and forward fill per serie
+  series = []
+  for unique_id, serie in df.groupby('unique_id'):
+    max_date = serie['ds'].max() if fixed_max_date is None else fixed_max_date
+    date_range = pd.date_range(start=serie['ds'].min(), end=max_date, freq=freq)
+    balanced = pd.DataFrame({'unique_id': unique_id, 'ds': date_range}).merge(serie, how='left', on=['unique_id', 'ds'])
+    series.append(balanced.ffill())
+  return pd.concat(series).reset_index(drop=True)[['unique_id', 'ds', 'y', 'x']]
+
+
+def _gapped(freq, n_series=5, n_time=30, seed=0):
+  # Series starting at different dates, with rows dropped at random
+  rng = np.random.RandomState(seed)
+  dfs = []
+  for i in range(n_series):
+    ds = pd.date_range('2000-01-31', periods=n_time, freq=freq)[i:]
+    keep = rng.rand(len(ds)) < 0.6
+    keep[[0, -1]] = True
+    dfs.append(pd.DataFrame({'unique_id': 'id_{}'.format(i), 'ds': ds[keep],
+                             'y': rng.rand(keep.sum()), 'x': 'c{}'.format(i % 2)}))
+  return pd.concat(dfs).reset_index(drop=True)
+
+
+@pytest.mark.parametrize('freq', ['D', 'H', 'W-THU', 'M'])
+def test_ffill_missing_dates_per_serie(freq):
+  df = _gapped(freq)
+  filled = ForecastingESRNNPrimitive._ffill_missing_dates_per_serie(df, freq)
+  pd.testing.assert_frame_equal(filled.reset_index(drop=True), _ffill_reference(df, freq))
+
+  fixed_max_date = df['ds'].max() + 3 * pd.tseries.frequencies.to_offset(freq)
+  filled = ForecastingESRNNPrimitive._ffill_missing_dates_per_serie(df, freq, fixed_max_date=fixed_max_date)
+  pd.testing.assert_frame_equal(filled.reset_index(drop=True), _ffill_reference(df, freq, fixed_max_date))
+
+
+@pytest.mark.parametrize('freq', ['D', '6H', 'W-THU', 'M'])
+def test_date_ranges(freq):
+  offset = pd.tseries.frequencies.to_offset(freq)
+  min_dates = pd.date_range('2000-01-31', periods=3, freq=freq)
+  dates = pd.DataFrame({'unique_id': ['a', 'b', 'c'], 'min_date': min_dates,
+                        'max_date': [min_date + n * offset for min_date, n in zip(min_dates, [0, 4, 9])]})
+  expected = pd.concat([pd.DataFrame({'unique_id': row.unique_id,
+                                      'ds': pd.date_range(row.min_date, row.max_date, freq=freq)})
+                        for row in dates.itertuples()]).reset_index(drop=True)
+  pd.testing.assert_frame_equal(ForecastingESRNNPrimitive._date_ranges(dates, freq), expected)
@@ -0,0 +1,27 @@
+import pandas as pd
+
+from esrnn.contrib.ESRNN import ESRNN
+
+
+def test_predict_without_rows(long_dfs, model_kwargs):
+  X_df, y_df = long_dfs
+  model = ESRNN(**model_kwargs)
+  model.fit(X_df, y_df)
+
+  Y_hat_panel = model.predict(X_df.iloc[:0])
+  assert len(Y_hat_panel) == 0
+  assert all([(col in Y_hat_panel) for col in ['unique_id', 'ds', 'y_hat']])
+
+
+def test_budgeted_fit_builds_es_cache_lazily(long_dfs, model_kwargs):
+  X_df, y_df = long_dfs
+  model = ESRNN(**model_kwargs)
+  model.fit(X_df, y_df, iterations=3)
+  assert model.train_stats['iterations_done'] == 3
+  assert model.es_cache is None
+
+  ids = X_df[['unique_id']].drop_duplicates()
+  Y_hat_panel = model.predict(ids)
+  assert model.es_cache is not None
+  model.build_es_cache()
+  pd.testing.assert_frame_equal(model.predict(ids), Y_hat_panel)
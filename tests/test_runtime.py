@@ -0,0 +1,29 @@
+import numpy as np
+import pytest
+
+from esrnn.contrib.ESRNN import ESRNN
+from esrnn.contrib.utils.runtime import NumpyESRNN
+
+
+@pytest.mark.parametrize('int_ids', [False, True])
+def test_numpy_bundle_round_trip(long_dfs, model_kwargs, tmp_path, int_ids):
+  X_df, y_df = long_dfs
+  if int_ids:
+    codes = dict((unique_id, i) for i, unique_id in enumerate(sorted(X_df['unique_id'].unique())))
+    X_df = X_df.assign(unique_id=X_df['unique_id'].map(codes))
+    y_df = y_df.assign(unique_id=y_df['unique_id'].map(codes))
+  ids = X_df[['unique_id']].drop_duplicates()
+
+  model = ESRNN(**model_kwargs)
+  model.fit(X_df, y_df)
+  path = str(tmp_path / 'esrnn.npz')
+  model.export_numpy(path)
+  runtime = NumpyESRNN(path)
+
+  # Queried by the ids the model was fitted with, of the same type
+  assert list(runtime.unique_ids) == ids['unique_id'].tolist()
+  assert all([type(unique_id) == type(fitted_id) for unique_id, fitted_id
+              in zip(runtime.unique_ids, ids['unique_id'].tolist())])
+  y_hat = model.predict(ids)['y_hat'].values.reshape(len(ids), -1)
+  np.testing.assert_allclose(runtime.predict(ids['unique_id'].tolist()), y_hat, rtol=1e-5)
+  np.testing.assert_allclose(runtime.predict(ids['unique_id'].values[::-1]), y_hat[::-1], rtol=1e-5)
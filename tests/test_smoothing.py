@@ -0,0 +1,36 @@
+import torch
+
+from esrnn.contrib.utils.smoothing import es_recursion
+
+
+def _es_reference(y, lev_sms, seas_sms, init_seas):
+  # Recursion of _ES with the python engine, differentiated by autograd
+  seasonality = init_seas.shape[1]
+  seasonalities = [init_seas[:, i] for i in range(seasonality)] + [init_seas[:, 0]]
+  levels = [y[:, 0] / seasonalities[0]]
+  for t in range(1, y.shape[1]):
+    newlev = lev_sms * (y[:, t] / seasonalities[t]) + (1-lev_sms) * levels[t-1]
+    levels.append(newlev)
+    seasonalities.append(seas_sms * (y[:, t] / newlev) + (1-seas_sms) * seasonalities[t])
+  return torch.stack(levels, 1), torch.stack(seasonalities, 1)
+
+
+def _inputs(n_series=3, n_time=11, seasonality=4):
+  torch.manual_seed(0)
+  y = 1 + torch.rand((n_series, n_time), dtype=torch.float64)
+  lev_sms = torch.rand(n_series, dtype=torch.float64, requires_grad=True)
+  seas_sms = torch.rand(n_series, dtype=torch.float64, requires_grad=True)
+  init_seas = (0.5 + torch.rand((n_series, seasonality), dtype=torch.float64)).requires_grad_(True)
+  return y, lev_sms, seas_sms, init_seas
+
+
+def test_es_recursion_matches_reference():
+  inputs = _inputs()
+  levels, seasonalities = es_recursion(*inputs)
+  ref_levels, ref_seasonalities = _es_reference(*inputs)
+  assert torch.allclose(levels, ref_levels)
+  assert torch.allclose(seasonalities, ref_seasonalities)
+
+
+def test_es_recursion_gradcheck():
+  assert torch.autograd.gradcheck(es_recursion, _inputs())
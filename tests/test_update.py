@@ -0,0 +1,30 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from esrnn.contrib.ESRNN import ESRNN
+from esrnn.contrib.utils.data import Iterator, Panel
+
+
+@pytest.mark.parametrize('stateful_rnn', [False, True])
+def test_update_matches_full_history_rebuild(long_dfs, model_kwargs, stateful_rnn):
+  X_df, y_df = long_dfs
+  cut = X_df.groupby('unique_id')['ds'].transform('max') - pd.Timedelta(days=5)
+  # Ragged updates, one serie gets fewer new observations
+  cut[X_df['unique_id'] == 'id_03'] += pd.Timedelta(days=3)
+  old = X_df['ds'] <= cut
+  ids = X_df[['unique_id']].drop_duplicates()
+
+  model = ESRNN(stateful_rnn=stateful_rnn, **model_kwargs)
+  model.fit(X_df[old], y_df[old], random_seed=1)
+  model.update(X_df[~old], y_df[~old])
+  updated = model.predict(ids)
+
+  # Same weights, ES state computed over the whole history
+  X, y = model.long_to_wide(X_df, y_df)
+  model.dataloader = Iterator(mc=model.mc, panel=Panel.from_wide(X, y))
+  model.es_cache = None
+  rebuilt = model.predict(ids)
+
+  np.testing.assert_allclose(updated['y_hat'].values, rebuilt['y_hat'].values, rtol=1e-5)
+  assert (updated['ds'].values == rebuilt['ds'].values).all()
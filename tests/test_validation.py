@@ -0,0 +1,37 @@
+import numpy as np
+import pandas as pd
+
+from esrnn.contrib.ESRNN import ESRNN
+from esrnn.contrib.utils.data import Iterator, Panel, long_to_wide
+
+
+def test_holdout_keeps_the_last_observations_out(long_dfs):
+  X_df, y_df = long_dfs
+  panel = Panel.from_wide(*long_to_wide(X_df, y_df))
+  train_panel = panel.holdout(8, 'D')
+  idxs = np.arange(panel.n_series)
+
+  last_y = np.stack(y_df.groupby('unique_id')['y'].apply(lambda y: y.values[-8:]).values)
+  np.testing.assert_allclose(panel.get_last_y(idxs, 8).numpy(), last_y, rtol=1e-6)
+  np.testing.assert_array_equal(train_panel.lengths, panel.lengths - 8)
+  np.testing.assert_array_equal(train_panel.get_last_y(idxs, 4).numpy(), panel.get_last_y(idxs, 12)[:, :4].numpy())
+  assert list(pd.DatetimeIndex(train_panel.last_ds)) == list(pd.DatetimeIndex(panel.last_ds) - pd.Timedelta(days=8))
+
+
+def test_early_stopping_restores_the_best_epoch(long_dfs, model_kwargs):
+  X_df, y_df = long_dfs
+  # Large steps, the validation loss gets worse before max_epochs
+  model = ESRNN(**dict(model_kwargs, max_epochs=10, learning_rate=0.1, val_freq=1, patience=1))
+  model.fit(X_df, y_df)
+  val_losses = model.train_stats['val_losses']
+  best = int(np.argmin(val_losses))
+  assert model.train_stats['early_stopped']
+  assert len(val_losses) == best + 1 + model.mc.patience < model.mc.max_epochs
+
+  # The fitted weights are those of the best evaluation, on the same holdout
+  panel = Panel.from_wide(*long_to_wide(X_df, y_df))
+  val_y = panel.get_last_y(np.arange(panel.n_series), model.mc.output_size)
+  dataloader = Iterator(mc=model.mc, panel=panel.holdout(model.mc.output_size, model.mc.frequency))
+  np.testing.assert_allclose(model._validate(dataloader, val_y), val_losses[best], rtol=1e-6)
+  assert model.dataloader.n_series == panel.n_series
+  np.testing.assert_array_equal(model.dataloader.len_series, panel.lengths)
@@ -0,0 +1,53 @@
+import numpy as np
+import pytest
+import torch
+
+from esrnn.contrib.ESRNN import ESRNN
+from esrnn.contrib.utils.data import Iterator, Panel, long_to_wide
+
+
+def _es_rows(model, unique_ids):
+  rows = torch.from_numpy(model.dataloader.get_idxs(unique_ids))
+  params = [param.detach()[rows] for param in model.esrnn.es.parameters()]
+  moments = [model.es_optimizer.state[param]['exp_avg'][rows] for param in model.esrnn.es.parameters()]
+  return params, moments
+
+
+@pytest.mark.parametrize('sparse_es', [False, True])
+def test_remap_es_follows_unique_ids(long_dfs, model_kwargs, sparse_es):
+  X_df, y_df = long_dfs
+  old_ids = ['id_{:02d}'.format(i) for i in range(8)]
+  model = ESRNN(sparse_es=sparse_es, **model_kwargs)
+  model.fit(X_df[X_df['unique_id'].isin(old_ids)], y_df[y_df['unique_id'].isin(old_ids)])
+  old_params, old_moments = _es_rows(model, old_ids)
+
+  # Known series in another order, with new ones in between
+  X, y = long_to_wide(X_df, y_df)
+  order = np.random.RandomState(0).permutation(len(X))
+  old_dataloader = model.dataloader
+  model.dataloader = Iterator(mc=model.mc, panel=Panel.from_wide(X[order], y[order]))
+  model.mc.n_series = model.dataloader.n_series
+  new_rows = model._remap_es(old_dataloader)
+
+  params, moments = _es_rows(model, old_ids)
+  for param, old_param in zip(params + moments, old_params + old_moments):
+    torch.testing.assert_close(param, old_param, rtol=0, atol=0)
+
+  new_ids = model.dataloader.unique_idxs[new_rows]
+  assert sorted(new_ids) == ['id_{:02d}'.format(i) for i in range(8, 12)]
+  params, moments = _es_rows(model, new_ids)
+  for param in params:
+    assert (param == 0.5).all()
+  for moment in moments:
+    assert (moment == 0).all()
+
+
+def test_warm_start_new_category(long_dfs, model_kwargs):
+  X_df, y_df = long_dfs
+  model = ESRNN(**model_kwargs)
+  model.fit(X_df, y_df)
+
+  X_df = X_df.copy()
+  X_df.loc[X_df['unique_id'] == 'id_00', 'x'] = 'new'
+  with pytest.raises(ValueError):
+    model.fit(X_df, y_df, warm_start=True, max_epochs=1)